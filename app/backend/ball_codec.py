@@ -0,0 +1,47 @@
+import struct
+import numpy as np
+
+BALLS_MEDIA_TYPE = "application/vnd.pingpong.balls"
+
+# Fixed color codes shared with the TypeScript decoder in app/services/api.ts.
+# Only append to this list, never reorder it.
+COLOR_CODES = ['unknown', 'red', 'orange', 'yellow', 'green', 'blue', 'purple', 'white']
+COLOR_TO_CODE = {color: code for code, color in enumerate(COLOR_CODES)}
+
+# Little endian layout:
+#   header: magic b'PB', version u8, reserved u8, frame id u32, timestamp f64, count u16
+#   body:   x int16[count], y int16[count], radius int16[count], color code u8[count],
+#           color confidence u8[count], detection score u8[count] (0-255 for 0.0-1.0)
+HEADER = struct.Struct('<2sBBIdH')
+MAGIC = b'PB'
+VERSION = 3
+
+
+def encode_balls(frame_id, timestamp, balls):
+    count = len(balls)
+    header = HEADER.pack(MAGIC, VERSION, 0, frame_id & 0xFFFFFFFF, timestamp, count)
+    if count == 0:
+        return header
+
+    xyr = np.array([(x, y, r) for (x, y, r, _, _, _) in balls], dtype='<i2')
+    colors = np.array([COLOR_TO_CODE.get(color, 0) for (_, _, _, color, _, _) in balls], dtype=np.uint8)
+    confidences = np.array([round(confidence * 255) for (_, _, _, _, confidence, _) in balls], dtype=np.uint8)
+    scores = np.array([round(score * 255) for (_, _, _, _, _, score) in balls], dtype=np.uint8)
+    return header + np.ascontiguousarray(xyr.T).tobytes() + colors.tobytes() + confidences.tobytes() + scores.tobytes()
+
+
+def decode_balls(payload):
+    magic, version, _, frame_id, timestamp, count = HEADER.unpack_from(payload, 0)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("Not a pingpong ball payload")
+
+    offset = HEADER.size
+    xyr = np.frombuffer(payload, dtype='<i2', count=3 * count, offset=offset).reshape(3, count)
+    colors = np.frombuffer(payload, dtype=np.uint8, count=count, offset=offset + 6 * count)
+    confidences = np.frombuffer(payload, dtype=np.uint8, count=count, offset=offset + 7 * count)
+    scores = np.frombuffer(payload, dtype=np.uint8, count=count, offset=offset + 8 * count)
+    balls = [
+        (int(x), int(y), int(r), COLOR_CODES[code] if code < len(COLOR_CODES) else 'unknown', int(confidence) / 255, int(score) / 255)
+        for x, y, r, code, confidence, score in zip(xyr[0], xyr[1], xyr[2], colors, confidences, scores)
+    ]
+    return frame_id, timestamp, balls
@@ -0,0 +1,491 @@
+import argparse
+import os
+import random
+import threading
+import time
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+
+from ball_codec import encode_balls
+from fast_json import FastJSONResponse, balls_to_json
+
+COLORS = ['red', 'orange', 'yellow', 'green', 'blue', 'purple', 'white']
+
+
+class PydanticBall(BaseModel):
+    x: int
+    y: int
+    color: str
+    radius: int
+    confidence: float
+    score: float
+
+
+def random_balls(count, seed=0):
+    rng = random.Random(seed)
+    return [
+        (rng.randint(0, 639), rng.randint(0, 479), rng.randint(15, 30), rng.choice(COLORS), rng.random(), rng.random())
+        for _ in range(count)
+    ]
+
+
+def time_call(fn, iterations):
+    fn()
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return (time.perf_counter() - start) / iterations
+
+
+def bench_serialization(args):
+    frame_base64 = 'A' * 40000
+
+    for count in (1, 20, 200):
+        balls = random_balls(count)
+
+        def pydantic_path():
+            content = {
+                "balls": [
+                    PydanticBall(x=x, y=y, color=color, radius=r, confidence=confidence, score=score)
+                    for (x, y, r, color, confidence, score) in balls
+                ],
+                "total_balls": len(balls),
+                "frame": frame_base64
+            }
+            return JSONResponse(jsonable_encoder(content)).body
+
+        def fast_path():
+            return FastJSONResponse({
+                "balls": balls_to_json(balls),
+                "total_balls": len(balls),
+                "frame": frame_base64
+            }).body
+
+        def compact_path():
+            return encode_balls(1, 0.0, balls)
+
+        print(f"{count} balls:")
+        for name, fn in (("pydantic + jsonable_encoder", pydantic_path), ("FastJSONResponse", fast_path), ("compact binary", compact_path)):
+            seconds = time_call(fn, args.iterations)
+            print(f"  {name:<28} {seconds * 1e6:9.1f} us  {len(fn()):7d} bytes")
+
+
+def bench_opcua_latency(args):
+    from opcua import Client
+    from opcua_server import ServoOpcuaServer
+    from servo import ServoController
+
+    endpoint = f"opc.tcp://127.0.0.1:{args.port}/freeopcua/server/"
+
+    for mode in ('poll', 'subscription'):
+        actuated = threading.Event()
+        expect = {'running': True}
+
+        def set_duty(duty):
+            if (duty != 0) == expect['running']:
+                actuated.set()
+
+        controller = ServoController(set_duty)
+        controller.start()
+        variables = {'speed_percentage': 50, 'min_angle': -45, 'max_angle': 45, 'stop': True}
+
+        def apply_change(name, value):
+            if name == 'StartServo':
+                if value and variables['stop']:
+                    variables['stop'] = False
+                    controller.start_sweep(variables, source='opcua')
+                elif not value and not variables['stop']:
+                    variables['stop'] = True
+                    controller.stop_sweep(source='opcua')
+
+        server = ServoOpcuaServer(endpoint)
+        server.start()
+        stop_polling = threading.Event()
+        if mode == 'subscription':
+            server.subscribe(apply_change)
+        else:
+            # The previous opcua_monitor(): read every input every 100 ms
+            def poll():
+                while not stop_polling.is_set():
+                    for name, variable in server.variables.items():
+                        apply_change(name, variable.get_value())
+                    time.sleep(0.1)
+            threading.Thread(target=poll, daemon=True).start()
+
+        client = Client(endpoint)
+        client.connect()
+        start_servo = client.get_node(server.variables['StartServo'].nodeid)
+        latencies = []
+        try:
+            for i in range(args.iterations):
+                expect['running'] = not expect['running'] if i else True
+                actuated.clear()
+                started = time.perf_counter()
+                start_servo.set_value(expect['running'])
+                if actuated.wait(2.0):
+                    latencies.append(time.perf_counter() - started)
+                time.sleep(0.05)
+        finally:
+            client.disconnect()
+            stop_polling.set()
+            server.stop()
+            controller.stop(1.0)
+
+        latencies.sort()
+        if latencies:
+            print(f"{mode:<13} command-to-actuation median {latencies[len(latencies) // 2] * 1000:6.1f} ms  "
+                  f"max {latencies[-1] * 1000:6.1f} ms  ({len(latencies)}/{args.iterations} actuated)")
+        else:
+            print(f"{mode:<13} no actuation observed")
+
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(int(fraction * len(sorted_values)), len(sorted_values) - 1)]
+
+
+def bench_sweep_jitter(args):
+    from hardware import SimulatedPWM
+    from servo import ServoController
+
+    stop_load = threading.Event()
+
+    def python_load():
+        # Stand-in for the vision pipeline holding the GIL in Python code
+        while not stop_load.is_set():
+            sum(i * i for i in range(20000))
+
+    for load_threads in sorted({0, args.load_threads}):
+        pwm = SimulatedPWM(25, 50)
+        controller = ServoController(pwm.ChangeDutyCycle, max_update_rate=args.rate)
+        controller.start()
+        stop_load.clear()
+        loaders = [threading.Thread(target=python_load, daemon=True) for _ in range(load_threads)]
+        for loader in loaders:
+            loader.start()
+
+        variables = {'speed_percentage': args.speed, 'min_angle': -45, 'max_angle': 45, 'stop': False}
+        controller.start_sweep(variables)
+        started = time.monotonic()
+        time.sleep(args.seconds)
+        stats = controller.sweep_engine.stats()
+        variables['stop'] = True
+        stop_load.set()
+        controller.stop(1.0)
+
+        times = [timestamp for (timestamp, duty) in pwm.get_trace(started) if duty]
+        intervals = sorted(b - a for a, b in zip(times, times[1:]))
+        print(f"{load_threads} load threads:")
+        print(f"  period requested {stats['requested_period'] * 1000:.1f} ms, achieved "
+              f"{(stats['achieved_period'] or 0) * 1000:.1f} ms over {stats['cycles']} cycles")
+        print(f"  overruns {stats['overruns']}, max lateness {stats['max_lateness_ms']:.2f} ms")
+        if intervals:
+            print(f"  PWM write interval p50 {percentile(intervals, 0.5) * 1000:.2f} ms, "
+                  f"p99 {percentile(intervals, 0.99) * 1000:.2f} ms, max {intervals[-1] * 1000:.2f} ms")
+
+
+def synthetic_frame(width=640, height=480, count=12, seed=0):
+    import cv2
+    import numpy as np
+
+    rng = np.random.default_rng(seed)
+    image = np.full((height, width, 3), 60, np.uint8)
+    palette = [(0, 0, 220), (0, 140, 255), (0, 230, 230), (0, 200, 0), (220, 80, 0), (200, 0, 160), (245, 245, 245)]
+    balls = []
+    for i in range(count):
+        x, y = int(rng.integers(40, width - 40)), int(rng.integers(40, height - 40))
+        r = int(rng.integers(17, 27))
+        cv2.circle(image, (x, y), r, palette[i % len(palette)], -1)
+        balls.append((x, y, r))
+    noise = rng.normal(0, 6, image.shape)
+    return np.clip(image + noise, 0, 255).astype(np.uint8), balls
+
+
+def first_match_color(hsv, mask):
+    # The classifier detection.py used before confidence scores, kept for comparison
+    import cv2
+    import numpy as np
+    from detection import color_ranges
+
+    for color, (lower, upper) in color_ranges.items():
+        color_mask = cv2.inRange(hsv, np.array(lower, np.uint8), np.array(upper, np.uint8))
+        if cv2.countNonZero(cv2.bitwise_and(mask, color_mask)) > 0:
+            return color
+    return "unknown"
+
+
+def bench_colors(args):
+    import cv2
+    import numpy as np
+    from detection import BallDetectionParams, classify_ball_color
+
+    min_confidence = BallDetectionParams().min_color_confidence
+    rng = np.random.default_rng(1)
+    results = {"first match": [0, 0.0], "histogram": [0, 0.0]}
+    total = 0
+    for seed in range(args.frames):
+        image, balls = synthetic_frame(args.width, args.height, seed=seed)
+        # Salt-and-pepper speckle of random colors, like sensor noise and reflections
+        speckle = rng.random(image.shape[:2]) < args.speckle
+        image[speckle] = rng.integers(0, 256, (int(speckle.sum()), 3), dtype=np.uint8)
+
+        # The old path converted the whole frame once per frame
+        started = time.perf_counter()
+        hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
+        results["first match"][1] += time.perf_counter() - started
+
+        for i, (x, y, r) in enumerate(balls):
+            expected = COLORS[i % len(COLORS)]
+            total += 1
+
+            started = time.perf_counter()
+            mask = np.zeros(image.shape[:2], np.uint8)
+            cv2.circle(mask, (x, y), r, 255, -1)
+            color = first_match_color(hsv, mask)
+            results["first match"][1] += time.perf_counter() - started
+            results["first match"][0] += color == expected
+
+            started = time.perf_counter()
+            color, _ = classify_ball_color(image, x, y, r, min_confidence)
+            results["histogram"][1] += time.perf_counter() - started
+            results["histogram"][0] += color == expected
+
+    for name, (correct, seconds) in results.items():
+        print(f"{name:<12} accuracy {correct / total:6.1%}  {seconds / total * 1e6:8.1f} us/ball")
+
+
+def allocated_per_call(fn, iterations):
+    import tracemalloc
+
+    fn()
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    for _ in range(iterations):
+        fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+def bench_detection(args):
+    from detection import BallDetectionParams, DetectionPipeline
+
+    image, _ = synthetic_frame(args.width, args.height)
+    params = BallDetectionParams()
+    reused = DetectionPipeline()
+    variants = (
+        ("fresh buffers", lambda: DetectionPipeline().detect(image, params)),
+        ("reused buffers", lambda: reused.detect(image, params)),
+    )
+    for name, fn in variants:
+        seconds = time_call(fn, args.iterations)
+        peak = allocated_per_call(fn, 5)
+        print(f"{name:<16} {seconds * 1000:8.2f} ms  peak allocation {peak / 1024:8.1f} KiB")
+
+
+def match_detections(truth, balls, tolerance):
+    # (matched, center error sum) pairing each true ball with the nearest unused detection
+    unused = list(balls)
+    matched, error = 0, 0.0
+    for (x, y, _) in truth:
+        best = min(unused, key=lambda ball: (ball[0] - x) ** 2 + (ball[1] - y) ** 2, default=None)
+        if best is None:
+            continue
+        distance = ((best[0] - x) ** 2 + (best[1] - y) ** 2) ** 0.5
+        if distance <= tolerance:
+            unused.remove(best)
+            matched += 1
+            error += distance
+    return matched, error
+
+
+def noisy_frames(args):
+    import numpy as np
+
+    rng = np.random.default_rng(1)
+    frames = []
+    for seed in range(args.frames):
+        image, truth = synthetic_frame(args.width, args.height, seed=seed)
+        speckle = rng.random(image.shape[:2]) < args.speckle
+        image[speckle] = rng.integers(0, 256, (int(speckle.sum()), 3), dtype=np.uint8)
+        frames.append((image, truth))
+    return frames
+
+
+def compare_params(frames, variants, title):
+    # Time, recall, precision and center error of each (name, BallDetectionParams overrides)
+    from detection import BallDetectionParams, DetectionPipeline
+
+    pipeline = DetectionPipeline()
+    print(f"{title:<28} {'ms':>7} {'recall':>7} {'precision':>9} {'center err px':>13}")
+    for name, overrides in variants:
+        params = BallDetectionParams(**overrides)
+        pipeline.detect(frames[0][0], params)
+        seconds = 0.0
+        truths = detections = matched = 0
+        error = 0.0
+        for image, truth in frames:
+            started = time.perf_counter()
+            balls = pipeline.detect(image, params)
+            seconds += time.perf_counter() - started
+            hits, hit_error = match_detections(truth, balls, tolerance=5)
+            truths += len(truth)
+            detections += len(balls)
+            matched += hits
+            error += hit_error
+        print(f"{name:<28} {seconds / len(frames) * 1000:7.2f} {matched / truths:7.1%} "
+              f"{matched / max(detections, 1):9.1%} {error / max(matched, 1):13.2f}")
+
+
+def bench_prefilter(args):
+    variants = [
+        ("bgr gaussian 15 (original)", dict(gray_first=False)),
+        ("gray gaussian 15", dict()),
+        ("gray gaussian 9", dict(blur_kernel=9)),
+        ("gray box 9", dict(blur='box', blur_kernel=9)),
+        ("gray median 5", dict(blur='median', blur_kernel=5)),
+        ("gray median 9", dict(blur='median', blur_kernel=9)),
+        ("gray bilateral 9", dict(blur='bilateral', blur_kernel=9)),
+        ("gray none", dict(blur='none')),
+        ("gray gaussian 7 @0.5", dict(blur_kernel=7, downscale=0.5)),
+        ("gray median 5 @0.5", dict(blur='median', blur_kernel=5, downscale=0.5)),
+    ]
+    compare_params(noisy_frames(args), variants, "pre-filter")
+
+
+def bench_detectors(args):
+    import config
+    from detection import BallDetectionParams, DetectionPipeline
+
+    variants = [
+        ("hough", dict(detector='hough')),
+        ("hough @0.5", dict(detector='hough', blur_kernel=7, downscale=0.5)),
+        ("contour", dict(detector='contour')),
+        ("contour @0.5", dict(detector='contour', downscale=0.5)),
+    ]
+    if config.ONNX_MODEL:
+        variants += [(f"onnx {size}", dict(detector='onnx', onnx_input_size=size)) for size in args.onnx_sizes]
+    else:
+        print("Set PINGPONG_ONNX_MODEL to include the onnx detector")
+    frames = noisy_frames(args)
+    compare_params(frames, variants, "detector")
+
+    if config.ONNX_MODEL:
+        pipeline = DetectionPipeline()
+        params = BallDetectionParams(detector='onnx', onnx_input_size=args.onnx_sizes[0])
+        images = [image for (image, _) in frames][:args.batch]
+        for batch in (1, len(images)):
+            def run():
+                for start in range(0, len(images), batch):
+                    pipeline.detect_batch(images[start:start + batch], params)
+            print(f"onnx batch {batch}: {time_call(run, 5) / len(images) * 1000:.2f} ms/frame")
+
+
+def bench_tiles(args):
+    import config
+
+    print(f"{os.cpu_count()} cpus, {config.DETECTION_TILE_WORKERS} tile workers")
+    frames = [synthetic_frame(args.width, args.height, count=args.balls, seed=seed) for seed in range(args.frames)]
+    for detector in args.detectors:
+        variants = [(f"{detector} {tiles}x{tiles}", dict(detector=detector, tiles=tiles)) for tiles in args.tiles]
+        compare_params(frames, variants, "tiles")
+
+
+def bench_cameras(args):
+    from cameras import CameraPipeline, CameraRegistry, DetectionScheduler
+    from lifecycle import LifecycleManager
+
+    image, _ = synthetic_frame(args.width, args.height)
+    for camera_count in range(1, args.cameras + 1):
+        registry = CameraRegistry()
+        for camera_id in range(camera_count):
+            registry.add(CameraPipeline(str(camera_id), None))
+        scheduler = DetectionScheduler(registry, interval=0.0)
+        lifecycle = LifecycleManager()
+
+        def feed(token, pipeline):
+            while not token.wait(1.0 / args.fps):
+                pipeline.publish_frame(image)
+
+        for pipeline in registry.all():
+            lifecycle.spawn(f"feed {pipeline.camera_id}", feed, pipeline)
+        for worker in range(args.workers):
+            lifecycle.spawn(f"detection {worker}", scheduler.run)
+        time.sleep(args.seconds)
+        lifecycle.shutdown()
+
+        per_camera = [pipeline.detections / args.seconds for pipeline in registry.all()]
+        print(f"{camera_count} cameras, {args.workers} workers: {sum(per_camera):6.1f} detections/s total, "
+              f"per camera min {min(per_camera):5.1f} max {max(per_camera):5.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pingpong backend micro-benchmarks")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    serialization = subparsers.add_parser("serialization", help="/track-balls response construction")
+    serialization.add_argument("--iterations", type=int, default=2000)
+    serialization.set_defaults(func=bench_serialization)
+
+    opcua_latency = subparsers.add_parser("opcua-latency", help="OPC UA write to servo actuation latency")
+    opcua_latency.add_argument("--iterations", type=int, default=20)
+    opcua_latency.add_argument("--port", type=int, default=48400)
+    opcua_latency.set_defaults(func=bench_opcua_latency)
+
+    sweep_jitter = subparsers.add_parser("sweep-jitter", help="Servo sweep timing on the simulated PWM backend")
+    sweep_jitter.add_argument("--seconds", type=float, default=5.0)
+    sweep_jitter.add_argument("--speed", type=int, default=90)
+    sweep_jitter.add_argument("--rate", type=float, default=100.0, help="Max servo update rate in Hz")
+    sweep_jitter.add_argument("--load-threads", type=int, default=2)
+    sweep_jitter.set_defaults(func=bench_sweep_jitter)
+
+    colors = subparsers.add_parser("colors", help="Ball color classification accuracy and cost")
+    colors.add_argument("--frames", type=int, default=20)
+    colors.add_argument("--speckle", type=float, default=0.02, help="Fraction of pixels replaced by random colors")
+    colors.add_argument("--width", type=int, default=640)
+    colors.add_argument("--height", type=int, default=480)
+    colors.set_defaults(func=bench_colors)
+
+    detection = subparsers.add_parser("detection", help="Single frame detection latency and allocations")
+    detection.add_argument("--iterations", type=int, default=50)
+    detection.add_argument("--width", type=int, default=640)
+    detection.add_argument("--height", type=int, default=480)
+    detection.set_defaults(func=bench_detection)
+
+    prefilter = subparsers.add_parser("prefilter", help="Cost and accuracy of the Hough pre-filter options")
+    prefilter.add_argument("--frames", type=int, default=20)
+    prefilter.add_argument("--speckle", type=float, default=0.02, help="Fraction of pixels replaced by random colors")
+    prefilter.add_argument("--width", type=int, default=640)
+    prefilter.add_argument("--height", type=int, default=480)
+    prefilter.set_defaults(func=bench_prefilter)
+
+    detectors = subparsers.add_parser("detectors", help="Cost and accuracy of the available detectors")
+    detectors.add_argument("--frames", type=int, default=20)
+    detectors.add_argument("--speckle", type=float, default=0.02, help="Fraction of pixels replaced by random colors")
+    detectors.add_argument("--width", type=int, default=640)
+    detectors.add_argument("--height", type=int, default=480)
+    detectors.add_argument("--onnx-sizes", type=int, nargs="+", default=[320, 416, 640])
+    detectors.add_argument("--batch", type=int, default=4)
+    detectors.set_defaults(func=bench_detectors)
+
+    tiles = subparsers.add_parser("tiles", help="Tiled parallel detection on high resolution frames")
+    tiles.add_argument("--frames", type=int, default=5)
+    tiles.add_argument("--balls", type=int, default=60)
+    tiles.add_argument("--tiles", type=int, nargs="+", default=[1, 2, 3, 4])
+    tiles.add_argument("--detectors", nargs="+", default=["hough", "contour"])
+    tiles.add_argument("--width", type=int, default=1920)
+    tiles.add_argument("--height", type=int, default=1080)
+    tiles.set_defaults(func=bench_tiles)
+
+    cameras = subparsers.add_parser("cameras", help="Aggregate detection throughput as cameras are added")
+    cameras.add_argument("--cameras", type=int, default=4)
+    cameras.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    cameras.add_argument("--fps", type=float, default=30.0)
+    cameras.add_argument("--seconds", type=float, default=3.0)
+    cameras.add_argument("--width", type=int, default=640)
+    cameras.add_argument("--height", type=int, default=480)
+    cameras.set_defaults(func=bench_cameras)
+
+    args = parser.parse_args()
+    args.func(args)
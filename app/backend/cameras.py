@@ -0,0 +1,547 @@
+import math
+import os
+import threading
+import time
+from collections import deque
+
+import cv2
+
+import config
+from detection import BallDetectionParams, detect_balls, detect_balls_batch
+from frame_bus import FrameBus, bus_name
+from latency import LatencyStats
+from result_cache import ResultCache
+from tracking import TemporalFilter
+
+
+class CameraPipeline:
+    # Whether requests may detect frames in this process, or only serve published results
+    local_detection = True
+
+    def __init__(self, camera_id, source, params=None, bus=None):
+        self.camera_id = camera_id
+        self.source = source
+        self.capture = None
+        # Optional FrameBus that frames and results are published to for other processes
+        self.bus = bus
+        self.bus_overflow = False
+        # Every params update bumps the version, results are cached per (frame id, version)
+        self.params_lock = threading.Lock()
+        self.params = params or BallDetectionParams()
+        self.params_version = 0
+        self.results = ResultCache(config.RESULT_CACHE_SIZE)
+        # Optional smoothing of the detection stream, disabled until configured
+        self.smoother = TemporalFilter()
+
+        # Newest captured frame with its sequence id, wall clock time and monotonic capture
+        # time; the latter is what latencies are measured from
+        self.frame_lock = threading.Lock()
+        self.frame = None
+        self.frame_id = 0
+        self.frame_timestamp = 0.0
+        self.frame_captured = 0.0
+        self.latency = LatencyStats()
+
+        # Newest background detection result with the frame it was detected on, listeners
+        # get (frame_id, timestamp, balls)
+        self.latest_detection = {'frame_id': 0, 'timestamp': 0.0, 'captured': 0.0, 'frame': None, 'balls': []}
+        self.listeners = []
+        self.last_detected_frame_id = 0
+        self.last_detection_start = 0.0
+        self.detections = 0
+        self.detection_seconds = 0.0
+        # Frames never detected although the camera was due for a detection (waiting for a
+        # worker or still busy with the previous one), and recent detection times. The
+        # scheduler sets due_at to the (capture time, frame id) from which on the camera
+        # wants its next detection; frames it skips on purpose before that are not dropped.
+        self.dropped_frames = 0
+        self.due_at = (0.0, 0)
+        self.captures = deque(maxlen=256)
+        self.detection_times = deque(maxlen=30)
+
+    def open(self):
+        self.capture = cv2.VideoCapture(self.source)
+        return self.capture.isOpened()
+
+    def release(self):
+        if self.capture is not None:
+            self.capture.release()
+        if self.bus is not None:
+            self.bus.close()
+
+    def publish_frame(self, image):
+        with self.frame_lock:
+            self.frame = image
+            self.frame_id += 1
+            self.frame_timestamp = time.time()
+            self.frame_captured = time.monotonic()
+            frame_id, frame_timestamp, frame_captured = self.frame_id, self.frame_timestamp, self.frame_captured
+            self.captures.append((frame_id, frame_captured))
+        if self.bus_accepts(image):
+            self.bus.write_frame(frame_id, frame_timestamp, frame_captured, image)
+
+    def bus_accepts(self, image):
+        # The bus is sized from the first frame, frames that outgrow its slots later on (the
+        # camera switched resolution) are kept out of it instead of failing the capture
+        if self.bus is None:
+            return False
+        if image.nbytes <= self.bus.max_frame_bytes:
+            return True
+        if not self.bus_overflow:
+            print(f"Camera {self.camera_id} frames of {image.nbytes} bytes do not fit the {self.bus.max_frame_bytes} byte frame bus slots, not publishing them.")
+            self.bus_overflow = True
+        return False
+
+    def capture_frames(self, token):
+        while not token.cancelled:
+            success, captured_frame = self.capture.read()
+            if success:
+                self.publish_frame(captured_frame)
+            token.wait(0.03)
+
+    def encode_jpeg(self, quality=80):
+        # (jpeg, frame_id, timestamp, captured) of the newest frame, or None
+        with self.frame_lock:
+            if self.frame is None:
+                return None
+            success, buffer = cv2.imencode('.jpg', self.frame, [cv2.IMWRITE_JPEG_QUALITY, quality])
+            frame_id, frame_timestamp, frame_captured = self.frame_id, self.frame_timestamp, self.frame_captured
+        return (buffer.tobytes(), frame_id, frame_timestamp, frame_captured) if success else None
+
+    def snapshot(self, newer_than=None, copy=True):
+        # (frame, frame_id, timestamp, captured) of the newest frame, or None if there is
+        # none (or nothing newer than newer_than).
+        # Captured frames are never written to after publishing, so callers that only
+        # read the pixels can skip the copy.
+        with self.frame_lock:
+            if self.frame is None or (newer_than is not None and self.frame_id <= newer_than):
+                return None
+            return self.frame.copy() if copy else self.frame, self.frame_id, self.frame_timestamp, self.frame_captured
+
+    def current_params(self):
+        with self.params_lock:
+            return self.params, self.params_version
+
+    def set_params(self, params):
+        # params are immutable, detections already running keep the set they started with
+        with self.params_lock:
+            self.params = params
+            self.params_version += 1
+        # Old entries could never be hit again, free them right away
+        self.results.clear()
+        self.publish_settings()
+
+    def publish_settings(self):
+        # Readers of the frame bus report the params and smoothing of this process
+        if self.bus is not None:
+            params, version = self.current_params()
+            self.bus.write_settings({'params': params.model_dump(), 'params_version': version, 'smoothing': self.smoother.enabled})
+
+    def detect_frame(self, current_frame, current_frame_id):
+        # Cached balls of the frame under the current params, detected on a miss
+        params, version = self.current_params()
+        return self.results.get_or_compute((current_frame_id, version), lambda: detect_balls(current_frame, params))
+
+    def trial_detection(self, params, runs=2):
+        # Milliseconds a detection of the newest frame takes under params, best of runs so
+        # the first run's buffer allocations do not count; None while there is no frame
+        snapshot = self.snapshot(copy=False)
+        if snapshot is None:
+            return None
+        best = None
+        for _ in range(runs):
+            started = time.perf_counter()
+            detect_balls(snapshot[0], params)
+            elapsed = (time.perf_counter() - started) * 1000
+            best = elapsed if best is None else min(best, elapsed)
+        return best
+
+    def next_frame(self):
+        # Newest frame that has not been detected yet, claimed for detection
+        snapshot = self.snapshot(newer_than=self.last_detected_frame_id, copy=False)
+        if snapshot is not None:
+            self.last_detected_frame_id = snapshot[1]
+        return snapshot
+
+    def count_dropped(self, claimed_frame_id):
+        # Called by the scheduler when it claims the camera again, before it moves due_at
+        if not self.last_detected_frame_id:
+            return
+        due_time, due_frame_id = self.due_at
+        with self.frame_lock:
+            captures = list(self.captures)
+        self.dropped_frames += sum(
+            1 for (frame_id, captured) in captures
+            if self.last_detected_frame_id < frame_id < claimed_frame_id and captured >= due_time and frame_id >= due_frame_id
+        )
+
+    def run_detection(self):
+        run_detections([self])
+
+    def finish_detection(self, current_frame, current_frame_id, current_frame_timestamp, current_frame_captured, balls, seconds, params_version):
+        # balls are the raw detection, the cache keeps them unsmoothed; seconds is None
+        # for results taken from the cache
+        balls = self.smoother.update(balls)
+        self.latency.record('detect', current_frame_captured)
+        if seconds is not None:
+            self.detection_seconds += seconds
+            self.detections += 1
+        self.detection_times.append(time.monotonic())
+
+        self.latest_detection = {
+            'frame_id': current_frame_id,
+            'timestamp': current_frame_timestamp,
+            'captured': current_frame_captured,
+            'frame': current_frame,
+            'balls': balls,
+        }
+        if self.bus_accepts(current_frame):
+            self.bus.write_result(current_frame_id, current_frame_timestamp, current_frame_captured, params_version, balls, current_frame)
+        for listener in self.listeners:
+            # A failing listener must not keep the others or the next cameras of a batch
+            # from getting their results
+            try:
+                listener(current_frame_id, current_frame_timestamp, balls)
+            except Exception as e:
+                print(f"Error in detection listener of camera {self.camera_id}: {e}")
+
+    def detected_snapshot(self, with_image=True):
+        # (frame, frame_id, timestamp, captured, balls) of the newest background detection,
+        # None before the first one. The frame is a private copy, or None without with_image.
+        latest = self.latest_detection
+        if not latest['frame_id']:
+            return None
+        image = latest['frame'].copy() if with_image else None
+        return image, latest['frame_id'], latest['timestamp'], latest['captured'], latest['balls']
+
+    def detection_stats(self):
+        times = list(self.detection_times)
+        return {
+            "detections": self.detections,
+            "detection_fps": (len(times) - 1) / (times[-1] - times[0]) if len(times) > 1 and times[-1] > times[0] else None,
+            "last_detection_age_ms": (time.monotonic() - times[-1]) * 1000 if times else None,
+            "dropped_frames": self.dropped_frames,
+        }
+
+    def status(self):
+        return {
+            "id": self.camera_id,
+            "source": self.source,
+            "opened": self.capture is not None and self.capture.isOpened(),
+            "frame_id": self.frame_id,
+            "detections": self.detections,
+            "mean_detection_ms": self.detection_seconds / self.detections * 1000 if self.detections else None,
+            "smoothing": self.smoother.enabled,
+            "params": self.params.model_dump(),
+            "params_version": self.params_version,
+            "result_cache": self.results.stats(),
+            "latency": self.latency.stats(),
+        }
+
+
+class BusCameraPipeline(CameraPipeline):
+    # Read side of a FrameBus: frames, detection results and settings come from the capture
+    # process. Params and smoothing are only ever changed there, so this process never
+    # detects on its own and serves the published results instead.
+    local_detection = False
+
+    def open(self):
+        if self.bus is None:
+            try:
+                self.bus = FrameBus(bus_name(self.camera_id))
+            except FileNotFoundError:
+                return False
+        return True
+
+    def release(self):
+        if self.bus is not None:
+            self.bus.close()
+            self.bus = None
+
+    def read_bus(self, consume, frame_id=None):
+        if not self.open():
+            return None
+
+        def track(image, frame_id, timestamp, captured):
+            self.frame_id = max(self.frame_id, frame_id)
+            return consume(image, frame_id, timestamp, captured)
+
+        return self.bus.read_frame(track, frame_id)
+
+    def encode_jpeg(self, quality=80):
+        def encode(image, frame_id, timestamp, captured):
+            success, buffer = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, quality])
+            return (buffer.tobytes(), frame_id, timestamp, captured) if success else None
+
+        return self.read_bus(encode)
+
+    def detected_snapshot(self, with_image=True, retries=3):
+        # The detected frame is kept in the result slot of the bus until the next result
+        # replaces it, in which case the newer result is read instead
+        if not self.open():
+            return None
+        for _ in range(retries):
+            result = self.bus.read_result()
+            if result is None:
+                return None
+            frame_id, timestamp, captured, _, balls = result
+            if not with_image:
+                return None, frame_id, timestamp, captured, balls
+            image = self.read_bus(lambda image, *_: image.copy(), frame_id)
+            if image is not None:
+                return image, frame_id, timestamp, captured, balls
+        return None
+
+    def snapshot(self, newer_than=None, copy=True):
+        # Frames always have to be copied out of the shared memory slot
+        def copy_out(image, frame_id, timestamp, captured):
+            if newer_than is not None and frame_id <= newer_than:
+                return None
+            return image.copy(), frame_id, timestamp, captured
+
+        return self.read_bus(copy_out)
+
+    def status(self):
+        settings = self.bus.read_settings() if self.open() else None
+        return {
+            "id": self.camera_id,
+            "source": "frame bus",
+            "opened": self.bus is not None,
+            "frame_id": self.frame_id,
+            "detections": None,
+            "mean_detection_ms": None,
+            "smoothing": settings['smoothing'] if settings else None,
+            "params": settings['params'] if settings else None,
+            "params_version": settings['params_version'] if settings else None,
+            "result_cache": None,
+            "latency": self.latency.stats(),
+        }
+
+
+def run_detections(pipelines):
+    # Cameras with equal params are detected as one batch, which batching detectors
+    # run in a single pass; the batch time is split evenly between them
+    groups = []
+    for pipeline in pipelines:
+        snapshot = pipeline.next_frame()
+        if snapshot is None:
+            continue
+        params, version = pipeline.current_params()
+        for (group_params, members) in groups:
+            if group_params == params:
+                members.append((pipeline, snapshot, version))
+                break
+        else:
+            groups.append((params, [(pipeline, snapshot, version)]))
+
+    for (params, members) in groups:
+        # Frames a request already detected (or is detecting) under the same params are
+        # not detected again
+        pending = []
+        for member in members:
+            pipeline, (frame, frame_id, timestamp, captured), version = member
+            balls = pipeline.results.get((frame_id, version))
+            if balls is None:
+                pending.append(member)
+            else:
+                pipeline.finish_detection(frame, frame_id, timestamp, captured, balls, None, version)
+        if not pending:
+            continue
+
+        started = time.perf_counter()
+        results = detect_balls_batch([frame for (_, (frame, _, _, _), _) in pending], params)
+        seconds = (time.perf_counter() - started) / len(pending)
+        for (pipeline, (frame, frame_id, timestamp, captured), version), balls in zip(pending, results):
+            pipeline.results.put((frame_id, version), balls)
+            pipeline.finish_detection(frame, frame_id, timestamp, captured, balls, seconds, version)
+
+
+class CameraRegistry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.cameras = {}
+
+    def add(self, pipeline):
+        with self.lock:
+            self.cameras[pipeline.camera_id] = pipeline
+        return pipeline
+
+    def get(self, camera_id):
+        return self.cameras.get(camera_id)
+
+    def primary(self):
+        # The first configured camera backs the single-camera endpoints
+        with self.lock:
+            return next(iter(self.cameras.values()), None)
+
+    def all(self):
+        with self.lock:
+            return list(self.cameras.values())
+
+
+# Thumbnail size frames are compared at by the 'motion' policy
+MOTION_THUMBNAIL = (32, 24)
+# Shortest interval of the adaptive policy when fps is unlimited
+MIN_ADAPTIVE_INTERVAL = 0.001
+
+
+class DetectionScheduler:
+    # Any number of workers share the cameras round-robin: each worker takes the next
+    # camera (after the one served last) that has a new frame and is due under the
+    # policy, so a slow or busy camera cannot starve the others. With batch_size > 1 a
+    # worker takes up to that many due cameras at once. Workers always detect the newest
+    # frame, frames captured while detection is behind are dropped, never queued.
+    #
+    # Policies:
+    #   fixed      detect each camera at up to fps
+    #   every_nth  detect every every_nth captured frame
+    #   adaptive   like fixed, but the rate is lowered (down to min_fps) while the process
+    #              uses more than target_load of all CPUs and raised again below it
+    #   motion     detect at min_fps while the scene is still, at fps for burst_seconds
+    #              after the frame changed by more than motion_threshold gray levels
+    POLICIES = ('fixed', 'every_nth', 'adaptive', 'motion')
+
+    def __init__(self, registry, interval, batch_size=1, policy='fixed'):
+        self.registry = registry
+        self.batch_size = batch_size
+        self.lock = threading.Lock()
+        self.cursor = 0
+        self.busy = set()
+        self.on_demand = True
+        # An interval of 0 detects every new frame as soon as a worker is free
+        self.configure(policy, 1 / interval if interval > 0 else math.inf, 1.0, 3, 0.5, 4.0, 1.0)
+
+    def configure(self, policy, fps, min_fps, every_nth, target_load, motion_threshold, burst_seconds):
+        if policy not in self.POLICIES:
+            raise ValueError(f"Unknown detection policy {policy}")
+        with self.lock:
+            self.policy = policy
+            self.fps = fps
+            self.min_fps = min_fps
+            self.every_nth = every_nth
+            self.target_load = target_load
+            self.motion_threshold = motion_threshold
+            self.burst_seconds = burst_seconds
+            # Current interval of the adaptive policy, starts at the full rate
+            self.interval = self.shortest_interval()
+            self.load_checked = (time.monotonic(), time.process_time())
+            self.cpu_load = None
+            self.thumbnails = {}
+            self.checked = {}
+            self.bursts = {}
+
+    def status(self):
+        with self.lock:
+            return {
+                "policy": self.policy,
+                "fps": None if math.isinf(self.fps) else self.fps,
+                "min_fps": self.min_fps,
+                "every_nth": self.every_nth,
+                "target_load": self.target_load,
+                "motion_threshold": self.motion_threshold,
+                "burst_seconds": self.burst_seconds,
+                "on_demand": self.on_demand,
+                "adaptive_fps": 1 / self.interval if self.policy == 'adaptive' and self.interval else None,
+                "cpu_load": self.cpu_load,
+            }
+
+    def shortest_interval(self):
+        return max(1 / self.fps, MIN_ADAPTIVE_INTERVAL)
+
+    def due_at(self, pipeline, now):
+        # (capture time, frame id) from which on the camera is due again after a
+        # detection claimed now
+        if self.policy == 'every_nth':
+            return 0.0, pipeline.frame_id + self.every_nth
+        if self.policy == 'adaptive':
+            return now + self.interval, 0
+        if self.policy == 'motion' and now >= self.bursts.get(pipeline.camera_id, 0.0):
+            return now + 1 / self.min_fps, 0
+        return now + 1 / self.fps, 0
+
+    def update_load(self, now):
+        # Share of all CPUs used by this process over the last second, the adaptive
+        # policy scales its interval by how far that is off target
+        checked, cpu_checked = self.load_checked
+        if now - checked < 1.0:
+            return
+        cpu = time.process_time()
+        self.cpu_load = (cpu - cpu_checked) / (now - checked) / (os.cpu_count() or 1)
+        self.load_checked = (now, cpu)
+        if self.policy == 'adaptive':
+            factor = min(max(self.cpu_load / self.target_load, 0.5), 2.0)
+            self.interval = min(max(self.interval * factor, self.shortest_interval()), 1 / self.min_fps)
+
+    def moved(self, pipeline):
+        # Whether the newest frame differs from the last frame that moved by more than
+        # motion_threshold mean gray levels, so slow drift triggers a burst eventually
+        snapshot = pipeline.snapshot(copy=False)
+        if snapshot is None or self.checked.get(pipeline.camera_id) == snapshot[1]:
+            return False
+        self.checked[pipeline.camera_id] = snapshot[1]
+        image = snapshot[0]
+        if image.ndim == 3:
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        thumbnail = cv2.resize(image, MOTION_THUMBNAIL, interpolation=cv2.INTER_AREA)
+        reference = self.thumbnails.get(pipeline.camera_id)
+        if reference is not None and cv2.absdiff(thumbnail, reference).mean() <= self.motion_threshold:
+            return False
+        self.thumbnails[pipeline.camera_id] = thumbnail
+        return reference is not None
+
+    def is_due(self, pipeline, now):
+        elapsed = now - pipeline.last_detection_start
+        if self.policy == 'every_nth':
+            return pipeline.frame_id - pipeline.last_detected_frame_id >= self.every_nth
+        if self.policy == 'adaptive':
+            return elapsed >= self.interval
+        if self.policy == 'motion':
+            if elapsed < 1 / self.fps:
+                return False
+            if now < self.bursts.get(pipeline.camera_id, 0.0):
+                return True
+            if self.moved(pipeline):
+                self.bursts[pipeline.camera_id] = now + self.burst_seconds
+                return True
+            return elapsed >= 1 / self.min_fps
+        return elapsed >= 1 / self.fps
+
+    def next_due(self, now):
+        with self.lock:
+            self.update_load(now)
+            cameras = self.registry.all()
+            due = []
+            start = self.cursor
+            for offset in range(len(cameras)):
+                index = (start + offset) % len(cameras)
+                pipeline = cameras[index]
+                if pipeline.camera_id in self.busy:
+                    continue
+                if pipeline.frame_id <= pipeline.last_detected_frame_id:
+                    continue
+                if not self.is_due(pipeline, now):
+                    continue
+                self.cursor = index + 1
+                self.busy.add(pipeline.camera_id)
+                pipeline.last_detection_start = now
+                pipeline.count_dropped(pipeline.frame_id)
+                pipeline.due_at = self.due_at(pipeline, now)
+                due.append(pipeline)
+                if len(due) >= self.batch_size:
+                    break
+            return due
+
+    def run(self, token):
+        while not token.cancelled:
+            due = self.next_due(time.monotonic())
+            if not due:
+                token.wait(0.005)
+                continue
+            try:
+                run_detections(due)
+            except Exception as e:
+                print(f"Error in detection for cameras {', '.join(pipeline.camera_id for pipeline in due)}: {e}")
+            finally:
+                with self.lock:
+                    for pipeline in due:
+                        self.busy.discard(pipeline.camera_id)
@@ -0,0 +1,81 @@
+import os
+import platform
+
+
+def env_flag(name, default):
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+# 'gpio' drives the real servo through RPi.GPIO, 'sim' records a simulated PWM trace,
+# 'none' disables servo control. 'auto' picks 'gpio' on ARM boards and 'none' elsewhere.
+HARDWARE_BACKEND = os.environ.get('PINGPONG_HARDWARE', 'auto').strip().lower()
+if HARDWARE_BACKEND == 'auto':
+    HARDWARE_BACKEND = 'gpio' if platform.machine().startswith(('arm', 'aarch64')) else 'none'
+
+SERVO_PIN = int(os.environ.get('PINGPONG_SERVO_PIN', 25))
+PWM_FREQUENCY = int(os.environ.get('PINGPONG_PWM_FREQUENCY', 50))
+
+OPCUA_ENABLED = env_flag('PINGPONG_OPCUA', HARDWARE_BACKEND != 'none')
+OPCUA_ENDPOINT = os.environ.get('PINGPONG_OPCUA_ENDPOINT', "opc.tcp://0.0.0.0:4840/freeopcua/server/")
+
+CAMERA_INDEX = int(os.environ.get('PINGPONG_CAMERA_INDEX', 0))
+
+
+def parse_cameras(value):
+    # "hopper=0,chute=1" -> {'hopper': 0, 'chute': 1}; non-numeric sources are passed
+    # to cv2.VideoCapture as-is (device paths, stream URLs)
+    cameras = {}
+    for entry in value.split(','):
+        camera_id, _, source = entry.strip().partition('=')
+        source = source.strip()
+        cameras[camera_id.strip()] = int(source) if source.isdigit() else source
+    return cameras
+
+
+# The first camera backs /video_feed, /track-balls and the servo feed control
+CAMERAS = parse_cameras(os.environ.get('PINGPONG_CAMERAS', f"0={CAMERA_INDEX}"))
+DETECTION_INTERVAL = float(os.environ.get('PINGPONG_DETECTION_INTERVAL', 0.1))
+DETECTION_WORKERS = int(os.environ.get('PINGPONG_DETECTION_WORKERS', min(os.cpu_count() or 1, len(CAMERAS))))
+# How the background detection decimates frames: 'fixed' (DETECTION_INTERVAL), 'every_nth',
+# 'adaptive' or 'motion', see cameras.DetectionScheduler; tunable at runtime
+DETECTION_POLICY = os.environ.get('PINGPONG_DETECTION_POLICY', 'fixed').strip().lower()
+# Cameras due at the same time with equal params are detected together, up to this many;
+# batches run in one forward pass with the ONNX detector
+DETECTION_BATCH = int(os.environ.get('PINGPONG_DETECTION_BATCH', 1))
+# Threads detecting the tiles of a frame when BallDetectionParams.tiles > 1
+DETECTION_TILE_WORKERS = int(os.environ.get('PINGPONG_DETECTION_TILE_WORKERS', os.cpu_count() or 1))
+# Model for the 'onnx' detector, see detection.OnnxDetector for the expected format
+ONNX_MODEL = os.environ.get('PINGPONG_ONNX_MODEL', '')
+# Detection results kept per camera, keyed by (frame id, params version)
+RESULT_CACHE_SIZE = int(os.environ.get('PINGPONG_RESULT_CACHE_SIZE', 16))
+# Temporal smoothing of each camera's detection stream, can also be toggled at runtime
+DETECTION_SMOOTHING = env_flag('PINGPONG_DETECTION_SMOOTHING', False)
+# Params updates whose trial detection takes longer than this are rejected unless
+# forced; by default the detection interval, slower detection makes the scheduler fall
+# behind. 0 (also the default with an interval of 0) means no budget.
+DETECTION_BUDGET_MS = max(float(os.environ.get('PINGPONG_DETECTION_BUDGET_MS', DETECTION_INTERVAL * 1000)), 0.0)
+# Active ball params of every camera are saved here and restored at startup, '' disables it
+PARAMS_FILE = os.path.expanduser(os.environ.get('PINGPONG_PARAMS_FILE', '~/.pingpong_ball_params.json'))
+
+# Multi-worker serving: with PINGPONG_HTTP_WORKERS > 1, `python main.py` starts one control
+# process that owns cameras, detection, servo and OPC UA ('writer') on CONTROL_PORT, and
+# uvicorn workers on HTTP_PORT that read frames and results from shared memory ('reader')
+# and forward everything else to the control process. 'off' keeps everything in-process.
+FRAME_BUS = os.environ.get('PINGPONG_FRAME_BUS', 'off').strip().lower()
+FRAME_BUS_SLOTS = int(os.environ.get('PINGPONG_FRAME_BUS_SLOTS', 4))
+# Minimum slot size, slots grow to fit the first frame of a camera
+FRAME_BUS_MAX_FRAME_BYTES = int(os.environ.get('PINGPONG_FRAME_BUS_MAX_FRAME_BYTES', 1920 * 1080 * 3))
+HTTP_WORKERS = int(os.environ.get('PINGPONG_HTTP_WORKERS', 1))
+HTTP_PORT = int(os.environ.get('PINGPONG_HTTP_PORT', 8000))
+CONTROL_PORT = int(os.environ.get('PINGPONG_CONTROL_PORT', 8001))
+
+# GET /admin/profile samples the stacks of all threads, up to PROFILE_MAX_SECONDS per call.
+# The API has no authentication, so it is off unless explicitly enabled.
+PROFILER_ENABLED = env_flag('PINGPONG_PROFILER', False)
+PROFILE_MAX_SECONDS = float(os.environ.get('PINGPONG_PROFILE_MAX_SECONDS', 30))
+
+# Upper bound for cancelling and joining background threads on shutdown, in seconds
+SHUTDOWN_TIMEOUT = float(os.environ.get('PINGPONG_SHUTDOWN_TIMEOUT', 5.0))
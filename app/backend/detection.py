@@ -0,0 +1,507 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Literal
+
+import cv2
+import numpy as np
+from pydantic import BaseModel, ConfigDict, Field, model_validator
+
+import config
+
+# Define the color ranges (in HSV space)
+color_ranges = {
+    'red': [(0, 120, 70), (10, 255, 255)],
+    'orange': [(10, 100, 20), (25, 255, 255)],
+    'yellow': [(25, 100, 20), (35, 255, 255)],
+    'green': [(35, 100, 20), (85, 255, 255)],
+    'blue': [(85, 100, 20), (125, 255, 255)],
+    'purple': [(125, 100, 20), (155, 255, 255)],
+    'white': [(0, 0, 200), (180, 55, 255)]
+}
+
+
+class BallDetectionParams(BaseModel):
+    # Immutable: a camera swaps in a whole new validated set, detections that already
+    # started keep the set they were started with. The bounds keep Hough out of its
+    # pathologically slow corners (dp < 1, tiny param2, huge kernels).
+    model_config = ConfigDict(frozen=True)
+
+    # One of DETECTORS
+    detector: Literal['hough', 'contour', 'onnx'] = 'hough'
+    min_radius: int = Field(15, ge=1, le=500)
+    max_radius: int = Field(30, ge=1, le=500)
+    dp: float = Field(1.2, ge=1, le=4)
+    minDist: int = Field(50, ge=1)
+    param1: int = Field(100, ge=1, le=1000)
+    param2: int = Field(30, ge=5, le=1000)
+    min_color_confidence: float = Field(0.3, ge=0, le=1)
+    # Pre-filter ahead of the Hough transform. Blurring the gray image is equivalent to
+    # converting a blurred BGR frame but a third of the work; gray_first=False, gaussian,
+    # 15 is the original chain. blur_kernel is rounded up to odd, downscale < 1 runs the
+    # Hough stage on a smaller image and scales the circles back up.
+    gray_first: bool = True
+    blur: Literal['gaussian', 'box', 'median', 'bilateral', 'none'] = 'gaussian'
+    blur_kernel: int = Field(15, ge=1, le=51)
+    downscale: float = Field(1.0, ge=0.1, le=1)
+    # ONNX detector: square network input size, box score and NMS overlap thresholds
+    onnx_input_size: int = Field(320, ge=32, le=1280)
+    onnx_score_threshold: float = Field(0.5, ge=0, le=1)
+    onnx_nms_threshold: float = Field(0.45, ge=0, le=1)
+    # Split the frame into tiles x tiles overlapping tiles detected in parallel, for
+    # high resolution cameras
+    tiles: int = Field(1, ge=1, le=8)
+
+    @model_validator(mode='after')
+    def check_radii(self):
+        if self.min_radius >= self.max_radius:
+            raise ValueError("min_radius must be smaller than max_radius")
+        return self
+
+
+# Label 0 is "no color range matched"; where ranges overlap the color listed first wins
+COLOR_LABELS = ['unknown'] + list(color_ranges)
+
+
+def color_lookup_tables():
+    # Per HSV channel, the bit set of colors whose range contains each value (at most 8
+    # colors), and the label of the lowest set bit, i.e. the color listed first
+    channel_bits = np.zeros((1, 256, 3), np.uint8)
+    for bit, (lower, upper) in enumerate(color_ranges.values()):
+        for channel in range(3):
+            channel_bits[0, lower[channel]:upper[channel] + 1, channel] |= 1 << bit
+    first_label = np.array([(bits & -bits).bit_length() for bits in range(256)], np.uint8)
+    return channel_bits, first_label
+
+
+CHANNEL_BITS, FIRST_LABEL = color_lookup_tables()
+
+
+def label_hsv(hsv, bits=None, scratch=None, labels=None):
+    # COLOR_LABELS index of every pixel, the same as cv2.inRange against every color
+    # range but in three table lookups. Optional dst buffers: bits has the shape of hsv,
+    # scratch and labels are single channel.
+    bits = cv2.LUT(hsv, CHANNEL_BITS, dst=bits)
+    labels = cv2.extractChannel(bits, 0, dst=labels)
+    for channel in (1, 2):
+        scratch = cv2.extractChannel(bits, channel, dst=scratch)
+        cv2.bitwise_and(labels, scratch, dst=labels)
+    return cv2.LUT(labels, FIRST_LABEL, dst=labels)
+
+
+@lru_cache(maxsize=128)
+def disk_mask(radius):
+    size = 2 * radius + 1
+    mask = np.zeros((size, size), np.uint8)
+    cv2.circle(mask, (radius, radius), radius, 1, -1)
+    return mask != 0
+
+
+def label_fractions(labels, x, y, r):
+    # Fraction of the disk (x, y, r) of a label image taken by each of COLOR_LABELS
+    height, width = labels.shape[:2]
+    x0, x1 = max(x - r, 0), min(x + r + 1, width)
+    y0, y1 = max(y - r, 0), min(y + r + 1, height)
+    if x0 >= x1 or y0 >= y1:
+        return np.zeros(len(COLOR_LABELS))
+    disk = disk_mask(r)[y0 - (y - r):y1 - (y - r), x0 - (x - r):x1 - (x - r)]
+    counts = np.bincount(labels[y0:y1, x0:x1][disk], minlength=len(COLOR_LABELS))
+    return counts / max(counts.sum(), 1)
+
+
+def color_histogram(image, x, y, r):
+    # label_fractions() of the ball, computed on its bounding box only
+    height, width = image.shape[:2]
+    x0, x1 = max(x - r, 0), min(x + r + 1, width)
+    y0, y1 = max(y - r, 0), min(y + r + 1, height)
+    if x0 >= x1 or y0 >= y1:
+        return np.zeros(len(COLOR_LABELS))
+    labels = label_hsv(cv2.cvtColor(image[y0:y1, x0:x1], cv2.COLOR_BGR2HSV))
+    return label_fractions(labels, x - x0, y - y0, r)
+
+
+def fractions_to_color(fractions, min_confidence):
+    label = int(np.argmax(fractions[1:])) + 1
+    confidence = float(fractions[label])
+    if confidence < min_confidence:
+        return 'unknown', confidence
+    return COLOR_LABELS[label], confidence
+
+
+def classify_ball_color(image, x, y, r, min_confidence):
+    # (color, confidence): the color covering most of the ball and the fraction of the
+    # ball it covers, 'unknown' when that fraction is below min_confidence
+    return fractions_to_color(color_histogram(image, x, y, r), min_confidence)
+
+
+# Balls are (x, y, r, color, color confidence, detection score). Scores come from the
+# ONNX model; Hough and contour detections do not rate their circles and all score 1.
+DEFAULT_SCORE = 1.0
+
+
+class HoughDetector:
+    # Circle Hough transform on the pre-filtered gray image, colors classified afterwards
+    def __init__(self, pipeline):
+        self.pipeline = pipeline
+
+    def detect(self, current_frame, params):
+        gray_frame = self.pipeline.prefilter(current_frame, params)
+        # gray_frame may be downscaled, circles are mapped back to current_frame coordinates
+        scale = gray_frame.shape[1] / current_frame.shape[1]
+        circles = cv2.HoughCircles(
+            gray_frame,
+            cv2.HOUGH_GRADIENT,
+            dp=params.dp,
+            minDist=max(params.minDist * scale, 1),
+            param1=params.param1,
+            param2=params.param2,
+            minRadius=round(params.min_radius * scale),
+            maxRadius=round(params.max_radius * scale)
+        )
+
+        balls = []
+        if circles is not None:
+            circles = np.round(circles[0, :] / scale).astype("int")
+
+            for (x, y, r) in circles:
+                color, confidence = classify_ball_color(current_frame, int(x), int(y), int(r), params.min_color_confidence)
+                balls.append((int(x), int(y), int(r), color, confidence, DEFAULT_SCORE))
+
+        return balls
+
+
+@lru_cache(maxsize=32)
+def ellipse_kernel(radius):
+    return cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (2 * radius + 1, 2 * radius + 1))
+
+
+# Contour detector tuning: median size for cleaning the label image, and the largest
+# share of a 1.4x larger disk a ball's color may fill before it counts as part of a
+# bigger colored region rather than a ball
+LABEL_MEDIAN = 5
+RING_SCALE = 1.4
+MAX_RING_FILL = 0.8
+
+
+class ContourDetector:
+    # For solid colored balls: label every pixel by color range once, then take ball
+    # centers as peaks of the distance to the nearest color boundary. Touching balls of
+    # different colors are split by their boundary, touching balls of the same color
+    # still give one distance peak each. Uses min_radius, max_radius, downscale and
+    # min_color_confidence; the Hough parameters and pre-filter do not apply.
+    def __init__(self, pipeline):
+        self.pipeline = pipeline
+
+    def label_image(self, current_frame, params):
+        pipeline = self.pipeline
+        image = pipeline.resize('contour scaled', current_frame, params.downscale)
+        shape = image.shape[:2]
+        hsv = pipeline.buffer('contour hsv', image.shape)
+        cv2.cvtColor(image, cv2.COLOR_BGR2HSV, dst=hsv)
+
+        bits = pipeline.buffer('contour bits', image.shape)
+        scratch = pipeline.buffer('contour scratch', shape)
+        mask = pipeline.buffer('contour mask', shape)
+        label_hsv(hsv, bits, scratch, mask)
+
+        # Isolated misclassified pixels would otherwise carve boundaries into the balls
+        labels = pipeline.buffer('contour labels', shape)
+        cv2.medianBlur(mask, LABEL_MEDIAN, dst=labels)
+        return labels
+
+    def detect(self, current_frame, params):
+        pipeline = self.pipeline
+        labels = self.label_image(current_frame, params)
+        scale = labels.shape[1] / current_frame.shape[1]
+        min_radius, max_radius = params.min_radius * scale, params.max_radius * scale
+        shape = labels.shape
+
+        # Colored pixels that are not on a boundary between labels
+        inside = pipeline.buffer('contour inside', shape)
+        cv2.morphologyEx(labels, cv2.MORPH_GRADIENT, ellipse_kernel(1), dst=inside)
+        cv2.compare(inside, 0, cv2.CMP_EQ, dst=inside)
+        colored = pipeline.buffer('contour colored', shape)
+        cv2.compare(labels, 0, cv2.CMP_GT, dst=colored)
+        cv2.bitwise_and(inside, colored, dst=inside)
+
+        # The L1 distance from a disk's center to its edge is still its radius, and unlike
+        # L2 it can be computed straight into 8 bits
+        distance = pipeline.buffer('contour distance', shape)
+        cv2.distanceTransform(inside, cv2.DIST_L1, 3, dstType=cv2.CV_8U, dst=distance)
+        # A square kernel is separable and cheaper than a disk
+        dilated = pipeline.buffer('contour dilated', shape)
+        size = 2 * max(int(min_radius) // 2, 1) + 1
+        cv2.dilate(distance, np.ones((size, size), np.uint8), dst=dilated)
+
+        # Local maxima deep enough to be the center of a ball of at least min_radius;
+        # the boundary pixel itself is not inside, hence the -1
+        peaks = pipeline.buffer('contour peaks', shape)
+        cv2.compare(distance, dilated, cv2.CMP_GE, dst=peaks)
+        cv2.compare(distance, min_radius - 1, cv2.CMP_GE, dst=colored)
+        cv2.bitwise_and(peaks, colored, dst=peaks)
+        points = cv2.findNonZero(peaks)
+
+        if points is None:
+            return []
+        points = points.reshape(-1, 2)
+        radii = distance[points[:, 1], points[:, 0]].astype(float) + 1
+
+        # Plateaus leave several peak pixels per ball, keep the deepest one
+        centers = []
+        balls = []
+        for index in np.argsort(-radii, kind='stable'):
+            x, y, r = int(points[index, 0]), int(points[index, 1]), float(radii[index])
+            if r > max_radius:
+                continue
+            if any((x - cx) ** 2 + (y - cy) ** 2 < min_radius ** 2 for (cx, cy) in centers):
+                continue
+            centers.append((x, y))
+            fractions = label_fractions(labels, x, y, int(round(r)))
+            label = int(np.argmax(fractions[1:])) + 1
+            if label_fractions(labels, x, y, int(round(r * RING_SCALE)))[label] > MAX_RING_FILL:
+                continue
+            color, confidence = fractions_to_color(fractions, params.min_color_confidence)
+            balls.append((int(round(x / scale)), int(round(y / scale)), int(round(r / scale)), color, confidence, DEFAULT_SCORE))
+
+        return balls
+
+
+class OnnxDetector:
+    # Small ONNX object detector (PINGPONG_ONNX_MODEL) run on the CPU through cv2.dnn.
+    # The model takes (batch, 3, size, size) RGB input scaled to [0, 1] and returns YOLO
+    # style boxes (cx, cy, w, h, scores...) in input pixels, either as
+    # (batch, boxes, 5 + classes) with an objectness column or as (batch, 4 + classes,
+    # boxes) without. Boxes become circles; colors are classified from the frame.
+    def __init__(self, pipeline):
+        if not config.ONNX_MODEL:
+            raise ValueError("No ONNX model configured, set PINGPONG_ONNX_MODEL")
+        # cv2.dnn defaults to its own backend on the CPU
+        self.net = cv2.dnn.readNetFromONNX(config.ONNX_MODEL)
+        self.batching = True
+
+    def detect(self, current_frame, params):
+        return self.detect_batch([current_frame], params)[0]
+
+    def detect_batch(self, frames, params):
+        size = params.onnx_input_size
+        outputs = None
+        if self.batching and len(frames) > 1:
+            try:
+                outputs = self.forward(frames, size)
+            except cv2.error:
+                # Exported with a fixed batch size of 1
+                self.batching = False
+        if outputs is None:
+            outputs = [self.forward([frame], size)[0] for frame in frames]
+        return [self.decode(frame, output, params) for frame, output in zip(frames, outputs)]
+
+    def forward(self, frames, size):
+        self.net.setInput(cv2.dnn.blobFromImages(frames, 1 / 255, (size, size), swapRB=True, crop=False))
+        return self.net.forward()
+
+    def decode(self, current_frame, output, params):
+        rows = output.reshape(output.shape[-2], output.shape[-1])
+        # There are always far more boxes than columns
+        if rows.shape[0] < rows.shape[1]:
+            rows = rows.T
+            scores = rows[:, 4:].max(axis=1)
+        else:
+            scores = rows[:, 4] * (rows[:, 5:].max(axis=1) if rows.shape[1] > 5 else 1)
+        keep = scores >= params.onnx_score_threshold
+        rows, scores = rows[keep], scores[keep]
+
+        height, width = current_frame.shape[:2]
+        scale_x, scale_y = width / params.onnx_input_size, height / params.onnx_input_size
+        boxes = [
+            [int((cx - w / 2) * scale_x), int((cy - h / 2) * scale_y), int(w * scale_x), int(h * scale_y)]
+            for (cx, cy, w, h) in rows[:, :4]
+        ]
+        indices = cv2.dnn.NMSBoxes(boxes, scores.tolist(), params.onnx_score_threshold, params.onnx_nms_threshold)
+
+        balls = []
+        for index in np.array(indices, dtype=int).reshape(-1):
+            x, y, w, h = boxes[index]
+            r = round((w + h) / 4)
+            if not params.min_radius <= r <= params.max_radius:
+                continue
+            x, y = x + w // 2, y + h // 2
+            color, confidence = classify_ball_color(current_frame, x, y, r, params.min_color_confidence)
+            balls.append((x, y, r, color, confidence, float(scores[index])))
+        return balls
+
+
+# Detectors by name, selected per camera through BallDetectionParams.detector. Detectors
+# with a detect_batch(frames, params) method get the frames of several cameras at once.
+DETECTORS = {
+    'hough': HoughDetector,
+    'contour': ContourDetector,
+    'onnx': OnnxDetector,
+}
+
+
+class DetectionPipeline:
+    # Owns the frame-sized work buffers of one detection thread and hands them to OpenCV
+    # as dst=, so steady-state detection does no large allocations. A buffer is
+    # reallocated only when the frame shape changes.
+    def __init__(self):
+        self.buffers = {}
+        self.detectors = {}
+
+    def buffer(self, name, shape, dtype=np.uint8):
+        buffer = self.buffers.get(name)
+        if buffer is None or buffer.shape != shape or buffer.dtype != dtype:
+            buffer = self.buffers[name] = np.empty(shape, dtype)
+        return buffer
+
+    def detector(self, name):
+        detector = self.detectors.get(name)
+        if detector is None:
+            detector = self.detectors[name] = DETECTORS[name](self)
+        return detector
+
+    def detect(self, current_frame, params):
+        if params.tiles > 1:
+            return detect_tiled(current_frame, params)
+        return self.detector(params.detector).detect(current_frame, params)
+
+    def detect_batch(self, frames, params):
+        if params.tiles > 1:
+            return [detect_tiled(frame, params) for frame in frames]
+        detector = self.detector(params.detector)
+        if hasattr(detector, 'detect_batch'):
+            return detector.detect_batch(frames, params)
+        return [detector.detect(frame, params) for frame in frames]
+
+    def prefilter(self, current_frame, params):
+        # Gray image for the Hough stage, params.downscale times the frame size
+        image = current_frame
+        if params.gray_first:
+            image = self.convert_gray('gray', image)
+        image = self.resize('scaled', image, params.downscale)
+        image = self.blur(image, params)
+        if not params.gray_first:
+            image = self.convert_gray('blurred gray', image)
+        return image
+
+    def resize(self, name, image, factor):
+        if factor >= 1:
+            return image
+        height, width = image.shape[:2]
+        size = (max(round(width * factor), 1), max(round(height * factor), 1))
+        scaled = self.buffer(name, (size[1], size[0]) + image.shape[2:])
+        cv2.resize(image, size, dst=scaled, interpolation=cv2.INTER_AREA)
+        return scaled
+
+    def convert_gray(self, name, image):
+        gray = self.buffer(name, image.shape[:2])
+        cv2.cvtColor(image, cv2.COLOR_BGR2GRAY, dst=gray)
+        return gray
+
+    def blur(self, image, params):
+        if params.blur == 'none':
+            return image
+        kernel = params.blur_kernel | 1
+        blurred = self.buffer('blurred', image.shape)
+        if params.blur == 'gaussian':
+            cv2.GaussianBlur(image, (kernel, kernel), 0, dst=blurred)
+        elif params.blur == 'box':
+            cv2.blur(image, (kernel, kernel), dst=blurred)
+        elif params.blur == 'median':
+            cv2.medianBlur(image, kernel, dst=blurred)
+        else:
+            cv2.bilateralFilter(image, kernel, 75, 75, dst=blurred)
+        return blurred
+
+
+# Pipelines are not thread safe, every thread running detections gets its own
+local_pipelines = threading.local()
+
+
+def local_pipeline():
+    pipeline = getattr(local_pipelines, 'pipeline', None)
+    if pipeline is None:
+        pipeline = local_pipelines.pipeline = DetectionPipeline()
+    return pipeline
+
+
+def detect_balls(current_frame, params):
+    return local_pipeline().detect(current_frame, params)
+
+
+def detect_balls_batch(frames, params):
+    # One result list per frame, all frames detected with the same params
+    return local_pipeline().detect_batch(frames, params)
+
+
+# Tiles are detected on a shared pool; OpenCV releases the GIL, so they run in parallel
+tile_executor = None
+tile_executor_lock = threading.Lock()
+
+
+def get_tile_executor():
+    global tile_executor
+    with tile_executor_lock:
+        if tile_executor is None:
+            tile_executor = ThreadPoolExecutor(config.DETECTION_TILE_WORKERS, thread_name_prefix='detection tile')
+        return tile_executor
+
+
+def shutdown_tile_executor():
+    global tile_executor
+    with tile_executor_lock:
+        if tile_executor is not None:
+            tile_executor.shutdown(wait=True, cancel_futures=True)
+            tile_executor = None
+
+
+def tile_bounds(height, width, tiles, overlap):
+    # (core, padded) per tile as (y0, y1, x0, x1): the cores partition the frame, the
+    # padded tiles extend them by overlap on every side
+    for row in range(tiles):
+        y0, y1 = height * row // tiles, height * (row + 1) // tiles
+        for column in range(tiles):
+            x0, x1 = width * column // tiles, width * (column + 1) // tiles
+            yield (y0, y1, x0, x1), (max(y0 - overlap, 0), min(y1 + overlap, height), max(x0 - overlap, 0), min(x1 + overlap, width))
+
+
+def detect_tile(current_frame, core, padded, params):
+    # Only balls centered in the core are kept. With an overlap of at least max_radius
+    # such a ball lies entirely inside the padded tile, so no tile sees it cut in half.
+    top, bottom, left, right = padded
+    balls = []
+    for (x, y, r, color, confidence, score) in detect_balls(current_frame[top:bottom, left:right], params):
+        x, y = x + left, y + top
+        if core[0] <= y < core[1] and core[2] <= x < core[3]:
+            balls.append((x, y, r, color, confidence, score))
+    return balls
+
+
+def suppress_duplicates(balls):
+    # Greedy non-maximum suppression for balls found twice across a tile seam: of any
+    # two circles containing each other's center keep the one with the higher detection
+    # score, the larger one on equal scores (Hough and contour score every ball 1)
+    kept = []
+    for ball in sorted(balls, key=lambda ball: (ball[5], ball[2]), reverse=True):
+        x, y, r = ball[:3]
+        if all((x - kx) ** 2 + (y - ky) ** 2 >= max(r, kr) ** 2 for (kx, ky, kr, _, _, _) in kept):
+            kept.append(ball)
+    return kept
+
+
+def detect_tiled(current_frame, params):
+    # +1 covers rounding of the detected centers and radii
+    overlap = params.max_radius + 1
+    tile_params = params.model_copy(update={'tiles': 1})
+    height, width = current_frame.shape[:2]
+    executor = get_tile_executor()
+    futures = [
+        executor.submit(detect_tile, current_frame, core, padded, tile_params)
+        for (core, padded) in tile_bounds(height, width, params.tiles, overlap)
+    ]
+    return suppress_duplicates([ball for future in futures for ball in future.result()])
+
+
+def annotate_frame(current_frame, balls):
+    for (x, y, r, color, _, _) in balls:
+        cv2.circle(current_frame, (x, y), r, (0, 255, 0), 4)
+        cv2.putText(current_frame, color, (x - r, y - r - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 255, 0), 2)
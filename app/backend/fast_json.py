@@ -0,0 +1,28 @@
+import json
+from fastapi.responses import Response
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def dumps(content):
+    if orjson is not None:
+        return orjson.dumps(content, option=orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(content, separators=(',', ':')).encode('utf-8')
+
+
+class FastJSONResponse(Response):
+    # Content must already be plain dicts/lists/scalars, there is no jsonable_encoder pass
+    media_type = "application/json"
+
+    def render(self, content):
+        return dumps(content)
+
+
+def balls_to_json(balls):
+    return [
+        {"x": x, "y": y, "color": color, "radius": r, "confidence": round(confidence, 3), "score": round(score, 3)}
+        for (x, y, r, color, confidence, score) in balls
+    ]
@@ -0,0 +1,117 @@
+import threading
+
+ANGLE_LIMIT = 60
+RANGE_STEP = 2
+RATE_SMOOTHING = 0.2
+
+
+class FeedController:
+    # Runs as a detection listener, so the loop ticks once per detection result.
+    # Balls that disappear from the hopper view between detections are counted as fed;
+    # the smoothed departure rate is driven to target_rate by a PI(D) loop on the sweep
+    # speed, and the sweep range is widened when speed alone is not enough.
+
+    def __init__(self, variables):
+        self.variables = variables
+        self.lock = threading.Lock()
+        self.enabled = False
+        self.target_rate = 2.0
+        self.kp = 8.0
+        self.ki = 4.0
+        self.kd = 0.0
+        self.min_speed = 10
+        self.max_speed = 95
+        self.base_range = (variables['min_angle'], variables['max_angle'])
+        self.reset()
+
+    def reset(self):
+        self.last_count = None
+        self.last_timestamp = None
+        self.last_error = None
+        # Assume the feed is on target until measured, and let the first control tick
+        # set the integrator (see on_detection)
+        self.measured_rate = self.target_rate
+        self.integral = 0.0
+
+    def configure(self, enabled, target_rate, kp, ki, kd, min_speed, max_speed):
+        with self.lock:
+            self.target_rate = target_rate
+            self.kp = kp
+            self.ki = ki
+            self.kd = kd
+            self.min_speed = min_speed
+            self.max_speed = max_speed
+            if enabled and not self.enabled:
+                self.base_range = (self.variables['min_angle'], self.variables['max_angle'])
+                self.reset()
+            elif not enabled and self.enabled:
+                self.variables['min_angle'], self.variables['max_angle'] = self.base_range
+            self.enabled = enabled
+
+    def status(self):
+        with self.lock:
+            return {
+                "enabled": self.enabled,
+                "target_rate": self.target_rate,
+                "measured_rate": self.measured_rate,
+                "speed_percentage": self.variables['speed_percentage'],
+                "min_angle": self.variables['min_angle'],
+                "max_angle": self.variables['max_angle'],
+                "kp": self.kp,
+                "ki": self.ki,
+                "kd": self.kd,
+                "min_speed": self.min_speed,
+                "max_speed": self.max_speed,
+            }
+
+    def on_detection(self, frame_id, timestamp, balls):
+        with self.lock:
+            if not self.enabled:
+                return
+            if self.variables['stop']:
+                # No balls leave while the sweep is stopped, so there is nothing to control;
+                # start over once it runs again so speed and range are picked up bumplessly
+                self.reset()
+                return
+            count = len(balls)
+            if self.last_timestamp is None or timestamp <= self.last_timestamp:
+                self.last_count = count
+                self.last_timestamp = timestamp
+                return
+
+            dt = timestamp - self.last_timestamp
+            departed = max(self.last_count - count, 0)
+            self.measured_rate += RATE_SMOOTHING * (departed / dt - self.measured_rate)
+            self.last_count = count
+            self.last_timestamp = timestamp
+
+            error = self.target_rate - self.measured_rate
+            first_tick = self.last_error is None
+            derivative = (error - self.last_error) / dt if not first_tick else 0.0
+            self.last_error = error
+
+            integral = self.integral + error * dt
+            if first_tick and self.ki:
+                # Bumpless switch-over: back-calculate the integrator so the first output
+                # is the speed the sweep is already running at
+                integral = (self.variables['speed_percentage'] - self.kp * error) / self.ki
+            output = self.kp * error + self.ki * integral + self.kd * derivative
+            speed = min(max(output, self.min_speed), self.max_speed)
+            # Anti-windup: stop integrating while the output is pinned at a limit
+            if speed == output or (speed == self.max_speed) != (error > 0):
+                self.integral = integral
+
+            # Whole percentages keep the precomputed sweep trajectories cacheable
+            self.variables['speed_percentage'] = int(round(speed))
+            self.adjust_range(error, speed)
+
+    def adjust_range(self, error, speed):
+        min_angle, max_angle = self.variables['min_angle'], self.variables['max_angle']
+        base_min, base_max = self.base_range
+        if speed >= self.max_speed and error > 0:
+            min_angle = max(min_angle - RANGE_STEP, -ANGLE_LIMIT)
+            max_angle = min(max_angle + RANGE_STEP, ANGLE_LIMIT)
+        elif speed <= self.min_speed and error < 0:
+            min_angle = min(min_angle + RANGE_STEP, base_min)
+            max_angle = max(max_angle - RANGE_STEP, base_max)
+        self.variables['min_angle'], self.variables['max_angle'] = min_angle, max_angle
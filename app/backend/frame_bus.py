@@ -0,0 +1,198 @@
+import json
+import struct
+import threading
+import time
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+from ball_codec import decode_balls, encode_balls
+
+# Shared memory layout:
+#   bus header:       magic, slot count, max frame bytes, frames written (u64)
+#   result region:    seq, payload length, capture time and params version of the detected
+#                     frame, latest ball result in the compact ball encoding
+#   settings region:  seq, payload length, detection settings of the writer as JSON
+#   frame slots:      slot header (seq, frame id, timestamp, monotonic capture time, shape),
+#                     frame pixels; `slots` ring slots plus one that holds the frame of the
+#                     latest result, so it can still be read after leaving the ring
+# Every region and slot is guarded by a sequence lock: the writer makes `seq` odd while it
+# updates them and even again afterwards, readers retry when `seq` changed underneath them.
+BUS_HEADER = struct.Struct('<4sIQQ')
+RESULT_HEADER = struct.Struct('<QIdQ')
+SETTINGS_HEADER = struct.Struct('<QI')
+SLOT_HEADER = struct.Struct('<QQddIII')
+MAGIC = b'PFB4'
+RESULT_BYTES = 16 * 1024
+SETTINGS_BYTES = 8 * 1024
+ALIGNMENT = 64
+
+
+def align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+RESULT_OFFSET = ALIGNMENT
+SETTINGS_OFFSET = align(RESULT_OFFSET + RESULT_HEADER.size + RESULT_BYTES)
+SLOTS_OFFSET = align(SETTINGS_OFFSET + SETTINGS_HEADER.size + SETTINGS_BYTES)
+
+
+def bus_name(camera_id):
+    return f"pingpong_{camera_id}"
+
+
+class FrameBus:
+    def __init__(self, name, slots=4, max_frame_bytes=1920 * 1080 * 3, create=False):
+        self.name = name
+        self.owner = create
+        if create:
+            slot_size = self.slot_size_for(max_frame_bytes)
+            try:
+                # A writer that crashed may have left its segment behind
+                stale = shared_memory.SharedMemory(name=name)
+                stale.close()
+                stale.unlink()
+            except FileNotFoundError:
+                pass
+            self.shm = shared_memory.SharedMemory(name=name, create=True, size=SLOTS_OFFSET + (slots + 1) * slot_size)
+            BUS_HEADER.pack_into(self.shm.buf, 0, MAGIC, slots, max_frame_bytes, 0)
+            RESULT_HEADER.pack_into(self.shm.buf, RESULT_OFFSET, 0, 0, 0.0, 0)
+            SETTINGS_HEADER.pack_into(self.shm.buf, SETTINGS_OFFSET, 0, 0)
+            for slot in range(slots + 1):
+                SLOT_HEADER.pack_into(self.shm.buf, SLOTS_OFFSET + slot * slot_size, 0, 0, 0.0, 0.0, 0, 0, 0)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+            # Readers must not unlink the writer's segment when they exit
+            resource_tracker.unregister(self.shm._name, 'shared_memory')
+            magic, slots, max_frame_bytes, _ = BUS_HEADER.unpack_from(self.shm.buf, 0)
+            if magic != MAGIC:
+                raise ValueError(f"{name} is not a pingpong frame bus")
+        self.slots = slots
+        self.max_frame_bytes = max_frame_bytes
+        self.slot_size = self.slot_size_for(max_frame_bytes)
+        self.write_lock = threading.Lock()
+
+    @staticmethod
+    def slot_size_for(max_frame_bytes):
+        return align(SLOT_HEADER.size + max_frame_bytes)
+
+    def slot_offset(self, slot):
+        return SLOTS_OFFSET + slot * self.slot_size
+
+    def close(self):
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+    def frames_written(self):
+        return BUS_HEADER.unpack_from(self.shm.buf, 0)[3]
+
+    def check_fits(self, image):
+        if image.nbytes > self.max_frame_bytes:
+            raise ValueError(f"Frame of {image.nbytes} bytes does not fit the {self.max_frame_bytes} byte bus slots")
+
+    def write_frame(self, frame_id, timestamp, captured, image):
+        self.check_fits(image)
+        with self.write_lock:
+            written = self.frames_written()
+            self.write_slot_locked(written % self.slots, frame_id, timestamp, captured, image)
+            struct.pack_into('<Q', self.shm.buf, 16, written + 1)
+
+    def write_slot_locked(self, slot, frame_id, timestamp, captured, image):
+        offset = self.slot_offset(slot)
+        height, width = image.shape[:2]
+        channels = image.shape[2] if image.ndim == 3 else 1
+
+        seq = SLOT_HEADER.unpack_from(self.shm.buf, offset)[0]
+        struct.pack_into('<Q', self.shm.buf, offset, seq + 1)
+        target = np.ndarray(image.shape, np.uint8, buffer=self.shm.buf, offset=offset + SLOT_HEADER.size)
+        np.copyto(target, image)
+        SLOT_HEADER.pack_into(self.shm.buf, offset, seq + 2, frame_id, timestamp, captured, height, width, channels)
+        del target
+
+    def write_result(self, frame_id, timestamp, captured, params_version, balls, image):
+        # The detected frame is copied into the result slot along with the balls
+        self.check_fits(image)
+        payload = encode_balls(frame_id, timestamp, balls)
+        if len(payload) > RESULT_BYTES:
+            raise ValueError(f"Result of {len(balls)} balls does not fit the bus result region")
+        with self.write_lock:
+            self.write_slot_locked(self.slots, frame_id, timestamp, captured, image)
+            self.write_region_locked(RESULT_OFFSET, RESULT_HEADER, payload, captured, params_version)
+
+    def read_result(self):
+        # (frame_id, timestamp, captured, params_version, balls) of the newest detection, or None
+        result = self.read_region(RESULT_OFFSET, RESULT_HEADER)
+        if result is None:
+            return None
+        payload, captured, params_version = result
+        frame_id, timestamp, balls = decode_balls(payload)
+        return frame_id, timestamp, captured, params_version, balls
+
+    def write_settings(self, settings):
+        payload = json.dumps(settings).encode('utf-8')
+        if len(payload) > SETTINGS_BYTES:
+            raise ValueError("Settings do not fit the bus settings region")
+        with self.write_lock:
+            self.write_region_locked(SETTINGS_OFFSET, SETTINGS_HEADER, payload)
+
+    def read_settings(self):
+        result = self.read_region(SETTINGS_OFFSET, SETTINGS_HEADER)
+        return json.loads(result[0]) if result is not None else None
+
+    def write_region_locked(self, offset, header, payload, *fields):
+        seq = header.unpack_from(self.shm.buf, offset)[0]
+        struct.pack_into('<Q', self.shm.buf, offset, seq + 1)
+        start = offset + header.size
+        self.shm.buf[start:start + len(payload)] = payload
+        header.pack_into(self.shm.buf, offset, seq + 2, len(payload), *fields)
+
+    def read_region(self, offset, header, retries=5):
+        # (payload, *extra header fields), or None if nothing was written yet
+        for _ in range(retries):
+            seq, length, *fields = header.unpack_from(self.shm.buf, offset)
+            if seq == 0:
+                return None
+            if seq % 2:
+                time.sleep(0.0005)
+                continue
+            start = offset + header.size
+            payload = bytes(self.shm.buf[start:start + length])
+            if header.unpack_from(self.shm.buf, offset)[0] == seq:
+                return (payload, *fields)
+        return None
+
+    def find_slot(self, frame_id):
+        # The newest ring slot, or whichever slot (including the result slot) has frame_id
+        if frame_id is None:
+            written = self.frames_written()
+            return (written - 1) % self.slots if written else None
+        for slot in range(self.slots + 1):
+            if SLOT_HEADER.unpack_from(self.shm.buf, self.slot_offset(slot))[1] == frame_id:
+                return slot
+        return None
+
+    def read_frame(self, consume, frame_id=None, retries=5):
+        # consume(image, frame_id, timestamp, captured) gets a zero-copy view into shared memory;
+        # whatever it returns is discarded and retried if the writer touched the slot meanwhile.
+        # Reads the newest frame, or the given frame id while it is still in the ring.
+        for _ in range(retries):
+            slot = self.find_slot(frame_id)
+            if slot is None:
+                return None
+            offset = self.slot_offset(slot)
+            seq, slot_frame_id, timestamp, captured, height, width, channels = SLOT_HEADER.unpack_from(self.shm.buf, offset)
+            if seq % 2:
+                time.sleep(0.0005)
+                continue
+            if frame_id is not None and slot_frame_id != frame_id:
+                return None
+
+            shape = (height, width, channels) if channels > 1 else (height, width)
+            image = np.ndarray(shape, np.uint8, buffer=self.shm.buf, offset=offset + SLOT_HEADER.size)
+            result = consume(image, slot_frame_id, timestamp, captured)
+            del image
+
+            if SLOT_HEADER.unpack_from(self.shm.buf, offset)[0] == seq:
+                return result
+        return None
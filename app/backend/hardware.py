@@ -0,0 +1,60 @@
+import threading
+import time
+from collections import deque
+
+
+class SimulatedPWM:
+    def __init__(self, pin, frequency, trace_size=100000):
+        self.pin = pin
+        self.frequency = frequency
+        self.duty_cycle = 0.0
+        self.lock = threading.Lock()
+        self.trace = deque(maxlen=trace_size)
+
+    def start(self, duty_cycle):
+        self.ChangeDutyCycle(duty_cycle)
+
+    def ChangeDutyCycle(self, duty_cycle):
+        with self.lock:
+            self.duty_cycle = duty_cycle
+            self.trace.append((time.monotonic(), duty_cycle))
+
+    def stop(self):
+        self.ChangeDutyCycle(0)
+
+    def get_trace(self, since=0.0):
+        with self.lock:
+            return [(timestamp, duty) for (timestamp, duty) in self.trace if timestamp >= since]
+
+
+class GpioPWM:
+    def __init__(self, pin, frequency):
+        import RPi.GPIO as GPIO
+
+        self.GPIO = GPIO
+        GPIO.setmode(GPIO.BCM)
+        GPIO.setup(pin, GPIO.OUT)
+        self.pwm = GPIO.PWM(pin, frequency)
+
+    def start(self, duty_cycle):
+        self.pwm.start(duty_cycle)
+
+    def ChangeDutyCycle(self, duty_cycle):
+        self.pwm.ChangeDutyCycle(duty_cycle)
+
+    def stop(self):
+        self.pwm.stop()
+        self.GPIO.cleanup()
+
+
+def create_pwm(backend, pin, frequency):
+    if backend == 'gpio':
+        pwm = GpioPWM(pin, frequency)
+    elif backend == 'sim':
+        pwm = SimulatedPWM(pin, frequency)
+    elif backend == 'none':
+        return None
+    else:
+        raise ValueError(f"Unknown hardware backend: {backend}")
+    pwm.start(0)
+    return pwm
@@ -0,0 +1,63 @@
+import bisect
+import threading
+import time
+
+# Upper bounds of the histogram buckets in milliseconds, one more bucket takes the rest
+BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+# Measured from the monotonic capture time of a frame until its detection result is
+# available, a /track-balls response for it is built, or it is sent on a video feed
+STAGES = ('detect', 'respond', 'stream')
+
+
+class LatencyHistogram:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = [0] * (len(BUCKETS_MS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, ms):
+        with self.lock:
+            self.counts[bisect.bisect_left(BUCKETS_MS, ms)] += 1
+            self.count += 1
+            self.total += ms
+            self.max = max(self.max, ms)
+
+    def percentile(self, fraction):
+        # Upper bound of the bucket the percentile falls into, the maximum for the last one
+        rank = fraction * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS_MS, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def stats(self):
+        with self.lock:
+            if not self.count:
+                return {"count": 0}
+            return {
+                "count": self.count,
+                "mean_ms": self.total / self.count,
+                "max_ms": self.max,
+                "p50_ms": self.percentile(0.5),
+                "p90_ms": self.percentile(0.9),
+                "p99_ms": self.percentile(0.99),
+                "buckets": [{"le_ms": bound, "count": count} for bound, count in zip(BUCKETS_MS + (None,), self.counts)],
+            }
+
+
+class LatencyStats:
+    # Capture to detect, respond and stream latency histograms of one camera
+    def __init__(self):
+        self.histograms = {stage: LatencyHistogram() for stage in STAGES}
+
+    def record(self, stage, captured, now=None):
+        now = time.monotonic() if now is None else now
+        self.histograms[stage].record((now - captured) * 1000)
+
+    def stats(self):
+        return {stage: histogram.stats() for stage, histogram in self.histograms.items()}
@@ -0,0 +1,96 @@
+import threading
+import time
+
+
+class CancellationToken:
+    def __init__(self):
+        self.event = threading.Event()
+        self.callbacks = []
+
+    @property
+    def cancelled(self):
+        return self.event.is_set()
+
+    def cancel(self):
+        self.event.set()
+        for callback in self.callbacks:
+            try:
+                callback()
+            except Exception as e:
+                print(f"Error in cancellation callback: {e}")
+
+    def wait(self, timeout):
+        # Interruptible sleep, returns True once cancelled
+        return self.event.wait(timeout)
+
+
+class LifecycleManager:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.threads = []
+        self.hooks = []
+        self.stopping = CancellationToken()
+
+    def spawn(self, name, target, *args):
+        # target receives a CancellationToken as its first argument and must return once it is cancelled
+        token = CancellationToken()
+        thread = threading.Thread(target=self.run_target, args=(name, target, token) + args, name=name, daemon=True)
+        with self.lock:
+            self.threads.append((name, thread, token))
+        thread.start()
+        return token
+
+    def adopt(self, name, thread, on_cancel):
+        # Take ownership of a thread started elsewhere, on_cancel must make it return
+        token = CancellationToken()
+        token.callbacks.append(on_cancel)
+        with self.lock:
+            self.threads.append((name, thread, token))
+        return token
+
+    def add_shutdown_hook(self, name, hook):
+        # Hooks run after all threads have been cancelled and joined, last registered first
+        with self.lock:
+            self.hooks.append((name, hook))
+
+    def run_target(self, name, target, token, *args):
+        try:
+            target(token, *args)
+        except Exception as e:
+            print(f"Thread {name} crashed: {e}")
+
+    def status(self):
+        with self.lock:
+            return [
+                {"name": name, "alive": thread.is_alive(), "cancelled": token.cancelled}
+                for (name, thread, token) in self.threads
+            ]
+
+    def shutdown(self, timeout=5.0):
+        deadline = time.monotonic() + timeout
+        self.stopping.cancel()
+        with self.lock:
+            threads = list(self.threads)
+            hooks = list(reversed(self.hooks))
+
+        for (_, _, token) in threads:
+            token.cancel()
+
+        report = []
+        for (name, thread, _) in threads:
+            started = time.monotonic()
+            thread.join(max(deadline - started, 0))
+            report.append({"name": name, "stopped": not thread.is_alive(), "seconds": time.monotonic() - started})
+
+        for (name, hook) in hooks:
+            # Hooks may block on hardware or network, so they get the same bounded budget
+            started = time.monotonic()
+            runner = threading.Thread(target=self.run_target, args=(name, lambda token: hook(), None), daemon=True)
+            runner.start()
+            runner.join(max(deadline - started, 0))
+            report.append({"name": name, "stopped": not runner.is_alive(), "seconds": time.monotonic() - started})
+
+        with self.lock:
+            self.threads = [entry for entry in self.threads if entry[1].is_alive()]
+            self.hooks = []
+        return report
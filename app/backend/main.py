@@ -1,16 +1,215 @@
-from fastapi import FastAPI, HTTPException, Query
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
+from fastapi.responses import Response, StreamingResponse
 import cv2
-import numpy as np
 from pydantic import BaseModel
 import io
+import os
+import asyncio
 import base64
-import platform
-import threading
 import time
+import urllib.error
+import urllib.request
+import config
+from ball_codec import BALLS_MEDIA_TYPE, encode_balls
+from cameras import BusCameraPipeline, CameraPipeline, CameraRegistry, DetectionScheduler
+from detection import BallDetectionParams, annotate_frame, shutdown_tile_executor
+from fast_json import FastJSONResponse, balls_to_json
+from feed_control import FeedController
+from frame_bus import FrameBus, bus_name
+from hardware import SimulatedPWM, create_pwm
+from lifecycle import LifecycleManager
+from params_store import load_params, save_params
+from profiler import collapsed, profile_lock, sample_stacks
+from servo import ServoController
 
-app = FastAPI()
+# Subsystems are created in the lifespan startup so importing this module touches no hardware
+pwm = None
+servo_controller = None
+opcua_server = None
+startup_report = {'subsystems': [], 'total_seconds': None}
+
+# Owns every background thread so shutdown can cancel and join them with a bounded timeout
+lifecycle = LifecycleManager()
+
+# Shared variables for servo control
+shared_variables = {
+    'speed_percentage': 50,
+    'min_angle': -45,
+    'max_angle': 45,
+    'stop': True
+}
+
+# One capture and detection pipeline per configured camera, opened at startup.
+# Frame bus readers get their frames and results from the control process instead.
+# Params saved by an earlier run are restored, cameras without any start with the defaults.
+is_bus_reader = config.FRAME_BUS == 'reader'
+cameras = CameraRegistry()
+saved_params = load_params(config.PARAMS_FILE)
+for camera_id, source in config.CAMERAS.items():
+    pipeline_class = BusCameraPipeline if is_bus_reader else CameraPipeline
+    pipeline = cameras.add(pipeline_class(camera_id, source, saved_params.get(camera_id)))
+    pipeline.smoother.enabled = config.DETECTION_SMOOTHING
+detection_scheduler = DetectionScheduler(cameras, config.DETECTION_INTERVAL, config.DETECTION_BATCH, config.DETECTION_POLICY)
+
+# Callbacks receiving (frame_id, timestamp, balls) from the primary camera's detections
+detection_listeners = cameras.primary().listeners
+
+# Closed-loop feed control adjusts the sweep from the detection stream when enabled
+feed_controller = FeedController(shared_variables)
+detection_listeners.append(feed_controller.on_detection)
+
+def start_servo():
+    global pwm, servo_controller
+    if is_bus_reader:
+        return 'in control process'
+    # Servo PWM backend is chosen by config, see config.HARDWARE_BACKEND
+    pwm = create_pwm(config.HARDWARE_BACKEND, config.SERVO_PIN, config.PWM_FREQUENCY)
+    if pwm is None:
+        print("Servo hardware disabled. Servo commands will be simulated.")
+        return 'disabled'
+
+    lifecycle.add_shutdown_hook('pwm', pwm.stop)
+
+    # The controller thread is the only place that touches the PWM
+    servo_controller = ServoController(pwm.ChangeDutyCycle)
+    lifecycle.adopt('servo', servo_controller.start(), servo_controller.interrupt)
+    print(f"Servo control enabled with '{config.HARDWARE_BACKEND}' PWM backend.")
+    return 'started'
+
+def apply_opcua_change(name, value):
+    if name == 'SpeedPercentage':
+        shared_variables['speed_percentage'] = value
+    elif name == 'MinSweepAngle':
+        shared_variables['min_angle'] = value
+    elif name == 'MaxSweepAngle':
+        shared_variables['max_angle'] = value
+    elif name == 'StartServo' and servo_controller is not None:
+        if value and shared_variables['stop']:
+            shared_variables['stop'] = False
+            print(f"Starting servo with speed: {shared_variables['speed_percentage']}%, min_angle: {shared_variables['min_angle']}, max_angle: {shared_variables['max_angle']}")
+            servo_controller.start_sweep(shared_variables, source='opcua')
+        elif not value and not shared_variables['stop']:
+            shared_variables['stop'] = True
+            print("Stopping servo.")
+            servo_controller.stop_sweep(source='opcua')
+
+def start_opcua():
+    global opcua_server
+    if is_bus_reader:
+        return 'in control process'
+    if not config.OPCUA_ENABLED:
+        return 'disabled'
+    from opcua_server import ServoOpcuaServer
+
+    # Start OPC UA server and apply writes as soon as the data change notifications arrive
+    server = ServoOpcuaServer(config.OPCUA_ENDPOINT)
+    server.start()
+    lifecycle.add_shutdown_hook('opcua', server.stop)
+    server.subscribe(apply_opcua_change)
+    detection_listeners.append(server.publish_detection)
+    opcua_server = server
+    return 'started'
+
+def start_cameras():
+    lifecycle.add_shutdown_hook('detection tiles', shutdown_tile_executor)
+    if is_bus_reader:
+        # Attaching is retried on every read until the control process has created the bus
+        attached = [pipeline.camera_id for pipeline in cameras.all() if pipeline.open()]
+        return f"reading frame bus for {', '.join(attached)}" if attached else 'waiting for control process'
+
+    opened = []
+    for pipeline in cameras.all():
+        lifecycle.add_shutdown_hook(f"camera {pipeline.camera_id}", pipeline.release)
+        if not pipeline.open():
+            print(f"Camera {pipeline.camera_id} ({pipeline.source}) could not be opened.")
+            continue
+        if config.FRAME_BUS == 'writer':
+            # Bus slots have to fit the camera's frames, so they are sized from the first one
+            success, first_frame = pipeline.capture.read()
+            if not success:
+                print(f"Camera {pipeline.camera_id} ({pipeline.source}) did not deliver a frame.")
+                continue
+            max_frame_bytes = max(config.FRAME_BUS_MAX_FRAME_BYTES, first_frame.nbytes)
+            if max_frame_bytes > config.FRAME_BUS_MAX_FRAME_BYTES:
+                print(f"Camera {pipeline.camera_id} frames are {first_frame.nbytes} bytes, growing its frame bus slots beyond PINGPONG_FRAME_BUS_MAX_FRAME_BYTES.")
+            pipeline.bus = FrameBus(bus_name(pipeline.camera_id), config.FRAME_BUS_SLOTS, max_frame_bytes, create=True)
+            pipeline.publish_settings()
+            pipeline.publish_frame(first_frame)
+        lifecycle.spawn(f"capture {pipeline.camera_id}", pipeline.capture_frames)
+        opened.append(pipeline.camera_id)
+    if not opened:
+        return 'unavailable'
+    for worker in range(config.DETECTION_WORKERS):
+        lifecycle.spawn(f"detection {worker}", detection_scheduler.run)
+    return f"started {', '.join(opened)}"
+
+def timed_start(name, start):
+    started = time.perf_counter()
+    try:
+        status = start()
+    except Exception as e:
+        print(f"Failed to start {name}: {e}")
+        status = f"failed: {e}"
+    return {'name': name, 'status': status, 'seconds': time.perf_counter() - started}
+
+def shutdown_subsystems():
+    shared_variables['stop'] = True
+    for entry in lifecycle.shutdown(config.SHUTDOWN_TIMEOUT):
+        state = 'stopped' if entry['stopped'] else 'still running'
+        print(f"Shutdown: {entry['name']} {state} after {entry['seconds'] * 1000:.0f} ms")
+
+@asynccontextmanager
+async def lifespan(app):
+    # Subsystems are independent, start them side by side and time each one
+    started = time.perf_counter()
+    subsystems = await asyncio.gather(
+        asyncio.to_thread(timed_start, 'servo', start_servo),
+        asyncio.to_thread(timed_start, 'opcua', start_opcua),
+        asyncio.to_thread(timed_start, 'cameras', start_cameras),
+    )
+    startup_report['subsystems'] = list(subsystems)
+    startup_report['total_seconds'] = time.perf_counter() - started
+    for subsystem in subsystems:
+        print(f"Startup: {subsystem['name']} {subsystem['status']} in {subsystem['seconds'] * 1000:.0f} ms")
+    yield
+    shutdown_subsystems()
+
+app = FastAPI(lifespan=lifespan)
+
+def served_by_reader(path):
+    # Frame and result reads are answered from shared memory, the rest needs the control process
+    if path in ('/', '/video_feed', '/track-balls', '/cameras', '/startup-report', '/threads'):
+        return True
+    return path.startswith('/cameras/') and path.endswith(('/video_feed', '/track-balls'))
+
+def forward_request(method, url, body, headers, timeout=10):
+    request = urllib.request.Request(url, data=body or None, method=method, headers=headers)
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            return response.status, response.headers, response.read()
+    except urllib.error.HTTPError as e:
+        return e.code, e.headers, e.read()
+
+if is_bus_reader:
+    @app.middleware("http")
+    async def forward_to_control_process(request: Request, call_next):
+        if served_by_reader(request.url.path):
+            return await call_next(request)
+        url = f"http://127.0.0.1:{config.CONTROL_PORT}{request.url.path}"
+        if request.url.query:
+            url += f"?{request.url.query}"
+        headers = {name: value for name, value in request.headers.items() if name in ('content-type', 'accept')}
+        # Profiles take as long as they sample
+        timeout = config.PROFILE_MAX_SECONDS + 10 if request.url.path == '/admin/profile' else 10
+        try:
+            status, response_headers, content = await asyncio.to_thread(forward_request, request.method, url, await request.body(), headers, timeout)
+        except OSError as e:
+            return FastJSONResponse({"detail": f"Control process unavailable: {e}"}, status_code=503)
+        # Custom X- headers such as X-Profile-Samples are part of the response
+        extra_headers = {name: value for name, value in response_headers.items() if name.lower().startswith('x-')}
+        return Response(content=content, status_code=status, media_type=response_headers.get('content-type'), headers=extra_headers)
 
 # Add CORS middleware
 app.add_middleware(
@@ -21,266 +220,338 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Check if running on Raspberry Pi
-is_raspberry_pi = platform.machine().startswith('arm')
-
-if is_raspberry_pi:
-    import RPi.GPIO as GPIO
-    from opcua import Server
-    
-    # Set up GPIO
-    GPIO.setmode(GPIO.BCM)
-    GPIO.setup(25, GPIO.OUT)
-    pwm = GPIO.PWM(25, 50)
-    pwm.start(0)
-    
-    # Set up OPC UA server
-    server = Server()
-    server.set_endpoint("opc.tcp://0.0.0.0:4840/freeopcua/server/")
-    namespace = server.register_namespace("ServoControl")
-    
-    # Create objects and variables in OPC UA server
-    objects = server.get_objects_node()
-    servo_obj = objects.add_object(namespace, "ServoControl")
-    start_servo_var = servo_obj.add_variable(namespace, "StartServo", False)
-    speed_percentage_var = servo_obj.add_variable(namespace, "SpeedPercentage", 50)
-    min_angle_var = servo_obj.add_variable(namespace, "MinSweepAngle", -45)
-    max_angle_var = servo_obj.add_variable(namespace, "MaxSweepAngle", 45)
-    
-    # Set variables to be writable from the client
-    start_servo_var.set_writable()
-    speed_percentage_var.set_writable()
-    min_angle_var.set_writable()
-    max_angle_var.set_writable()
-    
-    # Shared variables for servo control
-    shared_variables = {
-        'speed_percentage': 50,
-        'min_angle': -45,
-        'max_angle': 45,
-        'stop': True
-    }
-    
-    def angle_to_duty_cycle(angle):
-        return 2.5 + (angle + 60) * (10 / 120)
-    
-    def continuous_sweep(variables):
-        try:
-            while not variables['stop']:
-                min_duty = angle_to_duty_cycle(variables['min_angle'])
-                max_duty = angle_to_duty_cycle(variables['max_angle'])
-                delay = (100 - variables['speed_percentage']) / 1000.0
-    
-                for duty_cycle in range(int(min_duty * 10), int(max_duty * 10) + 1):
-                    if variables['stop']:
-                        break
-                    current_duty = duty_cycle / 10.0
-                    pwm.ChangeDutyCycle(current_duty)
-                    time.sleep(delay)
-    
-                for duty_cycle in range(int(max_duty * 10), int(min_duty * 10) - 1, -1):
-                    if variables['stop']:
-                        break
-                    current_duty = duty_cycle / 10.0
-                    pwm.ChangeDutyCycle(current_duty)
-                    time.sleep(delay)
-        
-        except Exception as e:
-            print(f"Error in sweeping: {e}")
-        finally:
-            pwm.ChangeDutyCycle(0)
-    
-    def opcua_monitor():
-        global shared_variables
-        running = False
-        while True:
-            try:
-                start_servo = start_servo_var.get_value()
-                speed_percentage = speed_percentage_var.get_value()
-                min_angle = min_angle_var.get_value()
-                max_angle = max_angle_var.get_value()
-    
-                shared_variables['speed_percentage'] = speed_percentage
-                shared_variables['min_angle'] = min_angle
-                shared_variables['max_angle'] = max_angle
-    
-                if start_servo and not running:
-                    shared_variables['stop'] = False
-                    print(f"Starting servo with speed: {speed_percentage}%, min_angle: {min_angle}, max_angle: {max_angle}")
-                    sweep_thread = threading.Thread(target=continuous_sweep, args=(shared_variables,))
-                    sweep_thread.start()
-                    running = True
-                elif not start_servo and running:
-                    shared_variables['stop'] = True
-                    print("Stopping servo.")
-                    running = False
-    
-            except Exception as e:
-                print(f"Error in OPC UA monitor: {e}")
-    
-            time.sleep(0.1)
-    
-    # Start OPC UA server
-    server.start()
-    print("OPC UA Server started at opc.tcp://0.0.0.0:4840/freeopcua/server/")
-    
-    # Start monitoring OPC UA variables in a separate thread
-    monitor_thread = threading.Thread(target=opcua_monitor)
-    monitor_thread.start()
-
-else:
-    print("Not running on Raspberry Pi. GPIO and OPC UA functionality will be simulated.")
-
-# Initialize camera
-camera = cv2.VideoCapture(0)
-
-# Global variables for frame sharing
-frame = None
-frame_lock = threading.Lock()
-
-# Define the color ranges (in HSV space)
-color_ranges = {
-    'red': [(0, 120, 70), (10, 255, 255)],
-    'orange': [(10, 100, 20), (25, 255, 255)],
-    'yellow': [(25, 100, 20), (35, 255, 255)],
-    'green': [(35, 100, 20), (85, 255, 255)],
-    'blue': [(85, 100, 20), (125, 255, 255)],
-    'purple': [(125, 100, 20), (155, 255, 255)],
-    'white': [(0, 0, 200), (180, 55, 255)]
-}
-
 class ServoAngle(BaseModel):
     angle: int
 
-class Ball(BaseModel):
-    x: int
-    y: int
-    color: str
-    radius: int
-
-class BallDetectionParams(BaseModel):
-    min_radius: int = 15
-    max_radius: int = 30
-    dp: float = 1.2
-    minDist: int = 50
-    param1: int = 100
-    param2: int = 30
-
-ball_params = BallDetectionParams()
-
-def detect_ball_color(hsv, mask):
-    for color, (lower, upper) in color_ranges.items():
-        lower_bound = np.array(lower, np.uint8)
-        upper_bound = np.array(upper, np.uint8)
-        color_mask = cv2.inRange(hsv, lower_bound, upper_bound)
-        combined_mask = cv2.bitwise_and(mask, color_mask)
-        if cv2.countNonZero(combined_mask) > 0:
-            return color
-    return "unknown"
-
-def capture_frames():
-    global frame
-    while True:
-        success, captured_frame = camera.read()
-        if success:
-            with frame_lock:
-                frame = captured_frame
-        time.sleep(0.03)
-
-threading.Thread(target=capture_frames, daemon=True).start()
+class FeedControlSettings(BaseModel):
+    enabled: bool = False
+    target_rate: float = 2.0
+    kp: float = 8.0
+    ki: float = 4.0
+    kd: float = 0.0
+    min_speed: int = 10
+    max_speed: int = 95
+
+class SmoothingSettings(BaseModel):
+    enabled: bool = False
+    alpha: float = 0.4
+    vote_window: int = 7
+    confirm_frames: int = 2
+    drop_frames: int = 3
+    match_distance: int = 25
+
+class SchedulerSettings(BaseModel):
+    policy: str = 'fixed'
+    fps: float = 10.0
+    min_fps: float = 1.0
+    every_nth: int = 3
+    target_load: float = 0.5
+    motion_threshold: float = 4.0
+    burst_seconds: float = 1.0
+    on_demand: bool = True
+
+def get_camera(camera_id):
+    pipeline = cameras.get(camera_id)
+    if pipeline is None:
+        raise HTTPException(status_code=404, detail=f"Unknown camera {camera_id}")
+    return pipeline
 
 @app.get("/")
 async def read_root():
     return {"message": "Pingpong Ball Feeder System API"}
 
-def generate_frames():
-    global frame
-    while True:
-        with frame_lock:
-            if frame is not None:
-                _, buffer = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, 80])
-                if _:
-                    yield (b'--frame\r\n'
-                           b'Content-Type: image/jpeg\r\n\r\n' + buffer.tobytes() + b'\r\n')
+@app.get("/admin/profile")
+async def profile(
+    seconds: float = Query(5.0, gt=0, description="How long to sample"),
+    interval_ms: float = Query(10.0, ge=1, le=1000, description="Time between samples"),
+):
+    # Collapsed stacks of all threads, ready for flamegraph.pl or speedscope. With the
+    # frame bus this profiles the control process, which runs capture and detection.
+    if not config.PROFILER_ENABLED:
+        raise HTTPException(status_code=404, detail="Profiling is disabled, see PINGPONG_PROFILER")
+    if seconds > config.PROFILE_MAX_SECONDS:
+        raise HTTPException(status_code=422, detail=f"Profiles are limited to {config.PROFILE_MAX_SECONDS:g} seconds")
+    if not profile_lock.acquire(blocking=False):
+        raise HTTPException(status_code=409, detail="A profile is already running")
+    try:
+        samples, stacks = await asyncio.to_thread(sample_stacks, seconds, interval_ms / 1000)
+    finally:
+        profile_lock.release()
+    return Response(content=collapsed(stacks), media_type="text/plain", headers={"X-Profile-Samples": str(samples)})
+
+@app.get("/startup-report")
+async def get_startup_report():
+    return startup_report
+
+@app.get("/threads")
+async def get_threads():
+    return lifecycle.status()
+
+def generate_frames(pipeline):
+    # Every part carries the frame's sequence id, wall clock and monotonic capture time
+    last_frame_id = None
+    while not lifecycle.stopping.cancelled:
+        encoded = pipeline.encode_jpeg(80)
+        if encoded is not None:
+            jpeg, frame_id, timestamp, captured = encoded
+            headers = f"X-Frame-Id: {frame_id}\r\nX-Frame-Timestamp: {timestamp:.6f}\r\nX-Frame-Captured: {captured:.6f}\r\n"
+            yield (b'--frame\r\n'
+                   b'Content-Type: image/jpeg\r\n' + headers.encode() + b'\r\n' + jpeg + b'\r\n')
+            if frame_id != last_frame_id:
+                pipeline.latency.record('stream', captured)
+                last_frame_id = frame_id
         time.sleep(0.016)
 
 @app.get("/video_feed")
 async def video_feed():
-    return StreamingResponse(generate_frames(), media_type="multipart/x-mixed-replace; boundary=frame")
+    return StreamingResponse(generate_frames(cameras.primary()), media_type="multipart/x-mixed-replace; boundary=frame")
 
-@app.get("/track-balls")
-async def track_balls():
-    global frame
-    with frame_lock:
-        if frame is None:
-            raise HTTPException(status_code=500, detail="No frame available")
-        current_frame = frame.copy()
-    
-    hsv = cv2.cvtColor(current_frame, cv2.COLOR_BGR2HSV)
-    blurred_frame = cv2.GaussianBlur(current_frame, (15, 15), 0)
-    gray_frame = cv2.cvtColor(blurred_frame, cv2.COLOR_BGR2GRAY)
-
-    circles = cv2.HoughCircles(
-        gray_frame,
-        cv2.HOUGH_GRADIENT,
-        dp=ball_params.dp,
-        minDist=ball_params.minDist,
-        param1=ball_params.param1,
-        param2=ball_params.param2,
-        minRadius=ball_params.min_radius,
-        maxRadius=ball_params.max_radius
-    )
+@app.get("/cameras/{camera_id}/video_feed")
+async def camera_video_feed(camera_id: str):
+    pipeline = get_camera(camera_id)
+    return StreamingResponse(generate_frames(pipeline), media_type="multipart/x-mixed-replace; boundary=frame")
 
-    balls = []
-    if circles is not None:
-        circles = np.round(circles[0, :]).astype("int")
+def track_balls_response(pipeline, request):
+    # Only the annotated JSON response draws on the frame and needs a private copy
+    compact = BALLS_MEDIA_TYPE in request.headers.get("accept", "")
+
+    # Smoothed results are only produced by the detection stream, so they are always
+    # reused, as are scheduled results when on-demand detection is off and every result
+    # on frame bus readers; the response then describes the frame they were detected on.
+    # Otherwise the background detection or an earlier request may already have processed
+    # the newest frame under the current params.
+    detected = None
+    if not pipeline.local_detection or pipeline.smoother.enabled or not detection_scheduler.on_demand:
+        detected = pipeline.detected_snapshot(with_image=not compact)
+        if detected is None and not pipeline.local_detection:
+            raise HTTPException(status_code=503, detail="No detection result from the control process yet")
+    if detected is not None:
+        current_frame, current_frame_id, current_frame_timestamp, current_frame_captured, balls = detected
+    else:
+        snapshot = pipeline.snapshot(copy=not compact)
+        if snapshot is None:
+            raise HTTPException(status_code=500, detail="No frame available")
+        current_frame, current_frame_id, current_frame_timestamp, current_frame_captured = snapshot
+        balls = pipeline.detect_frame(current_frame, current_frame_id)
 
-        for (x, y, r) in circles:
-            mask = np.zeros(gray_frame.shape, dtype=np.uint8)
-            cv2.circle(mask, (x, y), r, 255, -1)
-            color = detect_ball_color(hsv, mask)
-            cv2.circle(current_frame, (x, y), r, (0, 255, 0), 4)
-            cv2.putText(current_frame, color, (x - r, y - r - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 255, 0), 2)
-            balls.append(Ball(x=int(x), y=int(y), color=color, radius=int(r)))
+    # Compact consumers only want the results, so skip annotation and JPEG encoding
+    if compact:
+        payload = encode_balls(current_frame_id, current_frame_timestamp, balls)
+        age_ms = (time.monotonic() - current_frame_captured) * 1000
+        pipeline.latency.record('respond', current_frame_captured)
+        return Response(content=payload, media_type=BALLS_MEDIA_TYPE, headers={"X-Frame-Age-Ms": f"{age_ms:.1f}"})
 
+    annotate_frame(current_frame, balls)
     _, buffer = cv2.imencode('.jpg', current_frame)
     frame_base64 = base64.b64encode(buffer).decode('utf-8')
-    
-    return {
-        "balls": balls,
+    age_ms = (time.monotonic() - current_frame_captured) * 1000
+    pipeline.latency.record('respond', current_frame_captured)
+
+    return FastJSONResponse({
+        "balls": balls_to_json(balls),
         "total_balls": len(balls),
-        "frame": frame_base64
+        "frame": frame_base64,
+        "frame_id": current_frame_id,
+        "timestamp": current_frame_timestamp,
+        "age_ms": age_ms,
+    })
+
+# Plain def: detections run in the threadpool, off the event loop, so concurrent
+# requests for the same frame can wait on one detection
+@app.get("/track-balls", response_class=FastJSONResponse)
+def track_balls(request: Request):
+    return track_balls_response(cameras.primary(), request)
+
+@app.get("/cameras/{camera_id}/track-balls", response_class=FastJSONResponse)
+def camera_track_balls(camera_id: str, request: Request):
+    return track_balls_response(get_camera(camera_id), request)
+
+def check_detector(params):
+    if params.detector == 'onnx' and not config.ONNX_MODEL:
+        raise HTTPException(status_code=400, detail="The onnx detector needs PINGPONG_ONNX_MODEL")
+
+def save_ball_params():
+    try:
+        save_params(config.PARAMS_FILE, {pipeline.camera_id: pipeline.current_params()[0] for pipeline in cameras.all()})
+    except OSError as e:
+        print(f"Could not save ball params to {config.PARAMS_FILE}: {e}")
+
+async def apply_ball_params(pipeline, params, force):
+    # A trial detection on the newest frame estimates what the new params cost. Sets over
+    # the budget are rejected unless forced; a trial still running after a few budgets
+    # counts as over it (its thread finishes in the background). Without a budget the
+    # estimate is only reported.
+    check_detector(params)
+    budget_ms = config.DETECTION_BUDGET_MS or None
+    trial = asyncio.to_thread(pipeline.trial_detection, params)
+    if budget_ms is None:
+        estimated_ms = await trial
+        over_budget = False
+    else:
+        try:
+            estimated_ms = await asyncio.wait_for(trial, budget_ms * 4 / 1000)
+            over_budget = estimated_ms is not None and estimated_ms > budget_ms
+        except asyncio.TimeoutError:
+            estimated_ms = None
+            over_budget = True
+    if over_budget and not force:
+        took = f"{estimated_ms:.1f} ms" if estimated_ms is not None else f"over {budget_ms * 4:g} ms"
+        raise HTTPException(status_code=422, detail=f"A detection with these params takes {took}, over the {budget_ms:g} ms budget; pass force=true to apply them anyway")
+
+    pipeline.set_params(params)
+    await asyncio.to_thread(save_ball_params)
+    response = {
+        "message": "Ball detection parameters updated successfully",
+        "estimated_ms": estimated_ms,
+        "budget_ms": budget_ms,
     }
+    if over_budget:
+        response["warning"] = "Detection with these params exceeds the latency budget"
+    elif budget_ms is not None and estimated_ms is not None and estimated_ms > budget_ms / 2:
+        response["warning"] = "Detection with these params takes more than half the latency budget"
+    return response
 
 @app.post("/update-ball-params")
-async def update_ball_params(params: BallDetectionParams):
-    global ball_params
-    ball_params = params
-    return {"message": "Ball detection parameters updated successfully"}
+async def update_ball_params(params: BallDetectionParams, force: bool = Query(False, description="Apply params even if they exceed the detection budget")):
+    return await apply_ball_params(cameras.primary(), params, force)
+
+@app.post("/cameras/{camera_id}/update-ball-params")
+async def camera_update_ball_params(camera_id: str, params: BallDetectionParams, force: bool = Query(False, description="Apply params even if they exceed the detection budget")):
+    return await apply_ball_params(get_camera(camera_id), params, force)
+
+@app.get("/cameras")
+async def list_cameras():
+    return [pipeline.status() for pipeline in cameras.all()]
+
+# Capture to detect, respond and stream latency histograms. With the frame bus every
+# process only sees its own part: the control process detects, HTTP workers respond and
+# stream (see their /cameras).
+@app.get("/latency")
+async def latency_stats():
+    return {pipeline.camera_id: pipeline.latency.stats() for pipeline in cameras.all()}
+
+@app.get("/cameras/{camera_id}/latency")
+async def camera_latency_stats(camera_id: str):
+    return get_camera(camera_id).latency.stats()
 
 @app.post("/control-servo")
 async def control_servo(servo_angle: ServoAngle):
     if servo_angle.angle < -60 or servo_angle.angle > 60:
         raise HTTPException(status_code=400, detail="Angle must be between -60 and 60")
     
-    if is_raspberry_pi:
-        duty_cycle = angle_to_duty_cycle(servo_angle.angle)
-        pwm.ChangeDutyCycle(duty_cycle)
+    if servo_controller is not None:
+        if not servo_controller.move_to(servo_angle.angle, source='manual'):
+            raise HTTPException(status_code=409, detail="Servo is under OPC UA sweep control")
     else:
         print(f"Servo simulation: moved to {servo_angle.angle} degrees")
     
     return {"message": f"Servo moved to {servo_angle.angle} degrees"}
 
-@app.on_event("shutdown")
-def shutdown_event():
-    if is_raspberry_pi:
-        shared_variables['stop'] = True
-        monitor_thread.join()
-        server.stop()
-        GPIO.cleanup()
-        pwm.stop()
-    camera.release()
+@app.get("/servo/status")
+async def servo_status():
+    if servo_controller is None:
+        raise HTTPException(status_code=404, detail="Servo control is not available")
+    return servo_controller.status()
 
-if __name__ == "__main__":
+@app.get("/servo/sweep-stats")
+async def sweep_stats():
+    if servo_controller is None:
+        raise HTTPException(status_code=404, detail="Servo sweep is not available")
+    return servo_controller.sweep_engine.stats()
+
+@app.get("/feed-control")
+async def feed_control_status():
+    return feed_controller.status()
+
+@app.post("/feed-control")
+async def update_feed_control(settings: FeedControlSettings):
+    if not 0 <= settings.min_speed <= settings.max_speed <= 100:
+        raise HTTPException(status_code=400, detail="Speeds must satisfy 0 <= min_speed <= max_speed <= 100")
+    if settings.target_rate < 0:
+        raise HTTPException(status_code=400, detail="Target rate must not be negative")
+    feed_controller.configure(**settings.model_dump())
+    return feed_controller.status()
+
+def update_smoothing(pipeline, settings):
+    if not 0 < settings.alpha <= 1:
+        raise HTTPException(status_code=400, detail="alpha must be in (0, 1]")
+    if min(settings.vote_window, settings.confirm_frames, settings.match_distance) < 1 or settings.drop_frames < 0:
+        raise HTTPException(status_code=400, detail="Window, frame counts and match distance must be positive")
+    pipeline.smoother.configure(**settings.model_dump())
+    pipeline.publish_settings()
+    return pipeline.smoother.status()
+
+@app.get("/detection-smoothing")
+async def detection_smoothing_status():
+    return cameras.primary().smoother.status()
+
+@app.post("/detection-smoothing")
+async def update_detection_smoothing(settings: SmoothingSettings):
+    return update_smoothing(cameras.primary(), settings)
+
+@app.get("/cameras/{camera_id}/detection-smoothing")
+async def camera_detection_smoothing_status(camera_id: str):
+    return get_camera(camera_id).smoother.status()
+
+@app.post("/cameras/{camera_id}/detection-smoothing")
+async def camera_update_detection_smoothing(camera_id: str, settings: SmoothingSettings):
+    return update_smoothing(get_camera(camera_id), settings)
+
+@app.get("/detection-scheduler")
+async def detection_scheduler_status():
+    status = detection_scheduler.status()
+    status["cameras"] = {pipeline.camera_id: pipeline.detection_stats() for pipeline in cameras.all()}
+    return status
+
+@app.post("/detection-scheduler")
+async def update_detection_scheduler(settings: SchedulerSettings):
+    if settings.policy not in DetectionScheduler.POLICIES:
+        raise HTTPException(status_code=400, detail=f"policy must be one of {', '.join(DetectionScheduler.POLICIES)}")
+    if settings.fps <= 0 or not 0 < settings.min_fps <= settings.fps:
+        raise HTTPException(status_code=400, detail="fps must be positive and min_fps in (0, fps]")
+    if settings.every_nth < 1 or not 0 < settings.target_load <= 1 or settings.motion_threshold < 0 or settings.burst_seconds < 0:
+        raise HTTPException(status_code=400, detail="every_nth must be positive, target_load in (0, 1], motion_threshold and burst_seconds not negative")
+    values = settings.model_dump()
+    detection_scheduler.on_demand = values.pop('on_demand')
+    detection_scheduler.configure(**values)
+    return await detection_scheduler_status()
+
+@app.get("/servo/trace")
+async def servo_trace(since: float = Query(0.0, description="Only samples at or after this monotonic time")):
+    if not isinstance(pwm, SimulatedPWM):
+        raise HTTPException(status_code=404, detail="PWM trace is only recorded by the simulated backend")
+    return FastJSONResponse({"trace": pwm.get_trace(since)})
+
+@app.get("/opcua/stats")
+async def opcua_stats():
+    if opcua_server is None:
+        raise HTTPException(status_code=404, detail="OPC UA server is not available")
+    return opcua_server.stats()
+
+# Open /video_feed streams never finish on their own, uvicorn waits at most
+# SHUTDOWN_TIMEOUT for them before it runs the lifespan shutdown (PWM, GPIO, cameras)
+def run_control_server():
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    uvicorn.run("main:app", host="127.0.0.1", port=config.CONTROL_PORT, timeout_graceful_shutdown=config.SHUTDOWN_TIMEOUT)
+
+def run_multi_worker():
+    import multiprocessing
+    import uvicorn
+
+    # Environment is inherited by the spawned processes, which read their role from config
+    os.environ['PINGPONG_FRAME_BUS'] = 'writer'
+    control = multiprocessing.get_context('spawn').Process(target=run_control_server, name='control')
+    control.start()
+    try:
+        os.environ['PINGPONG_FRAME_BUS'] = 'reader'
+        uvicorn.run("main:app", host="0.0.0.0", port=config.HTTP_PORT, workers=config.HTTP_WORKERS, timeout_graceful_shutdown=config.SHUTDOWN_TIMEOUT)
+    finally:
+        control.terminate()
+        control.join(config.SHUTDOWN_TIMEOUT)
+
+if __name__ == "__main__":
+    if config.HTTP_WORKERS > 1:
+        run_multi_worker()
+    else:
+        import uvicorn
+        uvicorn.run(app, host="0.0.0.0", port=config.HTTP_PORT, timeout_graceful_shutdown=config.SHUTDOWN_TIMEOUT)
\ No newline at end of file
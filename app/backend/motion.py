@@ -0,0 +1,56 @@
+import math
+from functools import lru_cache
+
+import numpy as np
+
+PROFILES = ('linear', 'trapezoidal', 's-curve')
+
+# Share of the move spent accelerating (and again decelerating)
+ACCEL_FRACTION = 0.25
+
+
+@lru_cache(maxsize=32)
+def normalized_profile(kind, samples):
+    # Position in [0, 1] sampled at `samples` evenly spaced times over the move
+    tau = np.linspace(0.0, 1.0, samples)
+    if kind == 'linear':
+        return tau
+
+    ramp = np.clip(np.minimum(tau, 1.0 - tau) / ACCEL_FRACTION, 0.0, 1.0)
+    if kind == 's-curve':
+        # Smoothstep the velocity ramps so acceleration is continuous as well
+        ramp = ramp * ramp * (3.0 - 2.0 * ramp)
+    elif kind != 'trapezoidal':
+        raise ValueError(f"Unknown motion profile: {kind}")
+
+    position = np.concatenate(([0.0], np.cumsum((ramp[1:] + ramp[:-1]) / 2)))
+    return position / position[-1]
+
+
+def move_duration(distance, max_velocity, max_acceleration):
+    # Peak velocity and acceleration of the trapezoid for a move of the given duration
+    # are d / (T (1 - f)) and d / (T^2 f (1 - f)); pick the shortest T satisfying both
+    distance = abs(distance)
+    if distance == 0:
+        return 0.0
+    by_velocity = distance / (max_velocity * (1 - ACCEL_FRACTION))
+    by_acceleration = math.sqrt(distance / (max_acceleration * ACCEL_FRACTION * (1 - ACCEL_FRACTION)))
+    return max(by_velocity, by_acceleration)
+
+
+@lru_cache(maxsize=256)
+def move_trajectory(start_angle, end_angle, max_velocity, max_acceleration, kind, dt):
+    duration = move_duration(end_angle - start_angle, max_velocity, max_acceleration)
+    samples = max(int(math.ceil(duration / dt)) + 1, 2)
+    angles = start_angle + (end_angle - start_angle) * normalized_profile(kind, samples)
+    return tuple(float(angle) for angle in angles)
+
+
+@lru_cache(maxsize=256)
+def sweep_trajectory(min_angle, max_angle, period, kind, dt):
+    # One full min -> max -> min cycle sampled every dt seconds
+    half = max(int(round(period / (2 * dt))), 2)
+    out = min_angle + (max_angle - min_angle) * normalized_profile(kind, half + 1)
+    cycle = np.concatenate((out[:-1], out[::-1][:-1]))
+    return tuple(float(angle) for angle in cycle)
+
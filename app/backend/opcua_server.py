@@ -0,0 +1,134 @@
+import threading
+import time
+from datetime import datetime, timezone
+
+from opcua import Server, ua
+
+from ball_codec import COLOR_CODES, COLOR_TO_CODE
+
+# Writable servo inputs and their defaults
+SERVO_INPUTS = {
+    'StartServo': False,
+    'SpeedPercentage': 50,
+    'MinSweepAngle': -45,
+    'MaxSweepAngle': 45,
+}
+
+
+class DataChangeHandler:
+    def __init__(self, owner, on_change):
+        self.owner = owner
+        self.on_change = on_change
+
+    def datachange_notification(self, node, val, data):
+        name = self.owner.names.get(node.nodeid)
+        if name is None:
+            return
+        self.owner.record_notification(data.monitored_item.Value.SourceTimestamp)
+        try:
+            self.on_change(name, val)
+        except Exception as e:
+            print(f"Error handling OPC UA change of {name}: {e}")
+
+
+class ServoOpcuaServer:
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.server = Server()
+        self.server.set_endpoint(endpoint)
+        self.namespace = self.server.register_namespace("ServoControl")
+
+        # Create objects and variables in OPC UA server
+        objects = self.server.get_objects_node()
+        self.servo_obj = objects.add_object(self.namespace, "ServoControl")
+        self.variables = {}
+        for name, default in SERVO_INPUTS.items():
+            variable = self.servo_obj.add_variable(self.namespace, name, default)
+            variable.set_writable()
+            self.variables[name] = variable
+        self.names = {variable.nodeid: name for name, variable in self.variables.items()}
+
+        # Read-only detection results for the PLC
+        self.detection_obj = objects.add_object(self.namespace, "BallDetection")
+        outputs = [('FrameId', 0, ua.VariantType.UInt32), ('BallCount', 0, ua.VariantType.Int32)]
+        outputs += [(f"BallCount_{color}", 0, ua.VariantType.Int32) for color in COLOR_CODES]
+        outputs += [(name, [], ua.VariantType.Int32) for name in ('BallX', 'BallY', 'BallRadius', 'BallColorCode')]
+        self.outputs = {}
+        self.output_types = {}
+        for name, default, varianttype in outputs:
+            self.outputs[name] = self.detection_obj.add_variable(self.namespace, name, default, varianttype)
+            self.output_types[name] = varianttype
+        self.published = {}
+        self.last_publish = 0.0
+        self.publish_interval = 0.1
+
+        self.subscription = None
+        self.lock = threading.Lock()
+        self.notifications = 0
+        self.notify_delays = []
+
+    def start(self):
+        self.server.start()
+        print(f"OPC UA Server started at {self.endpoint}")
+
+    def stop(self):
+        if self.subscription is not None:
+            self.subscription.delete()
+            self.subscription = None
+        self.server.stop()
+
+    def subscribe(self, on_change, period=10):
+        # Server-side data change subscription, on_change(name, value) runs on the
+        # subscription thread as soon as a client writes one of the servo inputs
+        self.subscription = self.server.create_subscription(period, DataChangeHandler(self, on_change))
+        self.subscription.subscribe_data_change(list(self.variables.values()))
+
+    def publish_detection(self, frame_id, timestamp, balls):
+        # Rate limited; results arriving in between are dropped, the next one wins
+        now = time.monotonic()
+        if now - self.last_publish < self.publish_interval:
+            return
+        self.last_publish = now
+
+        counts = dict.fromkeys(COLOR_CODES, 0)
+        for (_, _, _, color, _, _) in balls:
+            counts[color if color in counts else 'unknown'] += 1
+
+        values = {
+            'FrameId': frame_id & 0xFFFFFFFF,
+            'BallCount': len(balls),
+            'BallX': [x for (x, _, _, _, _, _) in balls],
+            'BallY': [y for (_, y, _, _, _, _) in balls],
+            'BallRadius': [r for (_, _, r, _, _, _) in balls],
+            'BallColorCode': [COLOR_TO_CODE.get(color, 0) for (_, _, _, color, _, _) in balls],
+        }
+        for color, count in counts.items():
+            values[f"BallCount_{color}"] = count
+
+        # Only write what changed, FrameId alone is not worth a notification per frame
+        changed = [name for name, value in values.items() if name != 'FrameId' and self.published.get(name) != value]
+        if not changed:
+            return
+        changed.append('FrameId')
+        for name in changed:
+            self.outputs[name].set_value(ua.Variant(values[name], self.output_types[name]))
+            self.published[name] = values[name]
+
+    def record_notification(self, source_timestamp):
+        with self.lock:
+            self.notifications += 1
+            if source_timestamp is not None:
+                if source_timestamp.tzinfo is None:
+                    source_timestamp = source_timestamp.replace(tzinfo=timezone.utc)
+                delay = (datetime.now(timezone.utc) - source_timestamp).total_seconds()
+                self.notify_delays.append(delay)
+                del self.notify_delays[:-1000]
+
+    def stats(self):
+        with self.lock:
+            delays = sorted(self.notify_delays)
+            return {
+                "notifications": self.notifications,
+                "write_to_notify_ms_median": delays[len(delays) // 2] * 1000 if delays else None,
+                "write_to_notify_ms_max": delays[-1] * 1000 if delays else None,
+            }
@@ -0,0 +1,62 @@
+import json
+import os
+import tempfile
+import threading
+
+from pydantic import ValidationError
+
+import config
+from detection import BallDetectionParams
+
+# Active ball detection params of every camera, as {camera_id: params} JSON
+save_lock = threading.Lock()
+
+
+def load_params(path):
+    # Missing or unreadable files and invalid sets are skipped, those cameras start with
+    # the defaults
+    if not path:
+        return {}
+    try:
+        with open(path) as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        print(f"Ignoring saved ball params in {path}: {e}")
+        return {}
+    if not isinstance(data, dict):
+        print(f"Ignoring saved ball params in {path}: not a JSON object")
+        return {}
+
+    params = {}
+    for camera_id, values in data.items():
+        try:
+            camera_params = BallDetectionParams.model_validate(values)
+        except ValidationError as e:
+            print(f"Ignoring saved ball params of camera {camera_id}: {e}")
+            continue
+        if camera_params.detector == 'onnx' and not config.ONNX_MODEL:
+            print(f"Ignoring saved ball params of camera {camera_id}: the onnx detector needs PINGPONG_ONNX_MODEL")
+            continue
+        params[camera_id] = camera_params
+    return params
+
+
+def save_params(path, params):
+    # Written to a temporary file next to the target and renamed over it, so a crash
+    # mid-write leaves the previous file intact
+    if not path:
+        return
+    path = os.path.abspath(path)
+    with save_lock:
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.ball_params.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump({camera_id: p.model_dump() for camera_id, p in params.items()}, f, indent=2)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
@@ -0,0 +1,44 @@
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+# Only one profile runs at a time, samples of concurrent profiles would disturb each other
+profile_lock = threading.Lock()
+
+
+def frame_name(frame):
+    code = frame.f_code
+    name = getattr(code, 'co_qualname', code.co_name)
+    return f"{name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})"
+
+
+def sample_stacks(seconds, interval):
+    # Samples the Python stack of every other thread each interval seconds. Returns the
+    # number of samples taken and a Counter of collapsed stacks, "thread;outer;...;inner".
+    # Line numbers are part of the frames, so a thread waiting on a lock shows up on the
+    # line that acquires it.
+    stacks = Counter()
+    own_ident = threading.get_ident()
+    samples = 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == own_ident:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(frame_name(frame))
+                frame = frame.f_back
+            stack.append(names.get(ident, f"thread {ident}"))
+            stacks[';'.join(reversed(stack))] += 1
+        samples += 1
+        time.sleep(interval)
+    return samples, stacks
+
+
+def collapsed(stacks):
+    # flamegraph.pl / speedscope "collapsed" format, one "stack count" line per stack
+    return ''.join(f"{stack} {count}\n" for stack, count in stacks.most_common())
@@ -0,0 +1,280 @@
+import math
+import threading
+import time
+
+from motion import move_trajectory, sweep_trajectory
+
+MIN_SWEEP_PERIOD = 0.2
+
+
+def angle_to_duty_cycle(angle):
+    return 2.5 + (angle + 60) * (10 / 120)
+
+
+def sweep_period(speed_percentage, min_angle, max_angle):
+    # Keep the nominal timing of the old stepped loop: one 0.1% duty step
+    # every (100 - speed) ms, out and back
+    steps = abs(angle_to_duty_cycle(max_angle) - angle_to_duty_cycle(min_angle)) * 10
+    delay = max(100 - speed_percentage, 1) / 1000.0
+    return max(2 * steps * delay, MIN_SWEEP_PERIOD)
+
+
+class SweepEngine:
+    def __init__(self, update_interval=0.01, profile='trapezoidal'):
+        self.update_interval = update_interval
+        self.profile = profile
+        self.lock = threading.Lock()
+        self.reset(time.monotonic())
+
+    def reset(self, now):
+        self.phase = 0.0
+        self.last_tick = now
+        self.cycle_start = now
+        with self.lock:
+            self.requested_period = 0.0
+            self.achieved_periods = []
+            self.updates = 0
+            self.overruns = 0
+            self.max_lateness = 0.0
+
+    def stats(self):
+        with self.lock:
+            periods = self.achieved_periods[-20:]
+            return {
+                "requested_period": self.requested_period,
+                "achieved_period": sum(periods) / len(periods) if periods else None,
+                "last_period": periods[-1] if periods else None,
+                "cycles": len(self.achieved_periods),
+                "updates": self.updates,
+                "overruns": self.overruns,
+                "max_lateness_ms": self.max_lateness * 1000,
+            }
+
+    def step(self, variables, now):
+        # Position is derived from the monotonic clock instead of counting steps,
+        # so late wakeups cost resolution but never stretch the sweep period
+        period = sweep_period(variables['speed_percentage'], variables['min_angle'], variables['max_angle'])
+        self.phase += (now - self.last_tick) / period
+        self.last_tick = now
+
+        if self.phase >= 1.0:
+            self.phase %= 1.0
+            with self.lock:
+                self.achieved_periods.append(now - self.cycle_start)
+                del self.achieved_periods[:-1000]
+            self.cycle_start = now
+
+        with self.lock:
+            self.requested_period = period
+            self.updates += 1
+
+        trajectory = sweep_trajectory(
+            float(variables['min_angle']), float(variables['max_angle']),
+            round(period, 3), self.profile, self.update_interval
+        )
+        return trajectory[min(int(self.phase * len(trajectory)), len(trajectory) - 1)]
+
+    def record_overrun(self, lateness):
+        with self.lock:
+            self.overruns += 1
+            self.max_lateness = max(self.max_lateness, lateness)
+
+
+class ServoController:
+    # Higher priority sources may take the servo away from lower ones, never the reverse
+    PRIORITY = {'manual': 0, 'opcua': 1}
+
+    def __init__(self, set_duty, max_update_rate=100.0, profile='trapezoidal', max_velocity=300.0, max_acceleration=3000.0):
+        self.set_duty = set_duty
+        self.update_interval = 1.0 / max_update_rate
+        self.profile = profile
+        self.max_velocity = max_velocity
+        self.max_acceleration = max_acceleration
+        self.sweep_engine = SweepEngine(self.update_interval, profile)
+
+        self.condition = threading.Condition()
+        self.pending = None
+        self.owner = None
+        self.mode = 'idle'
+        self.running = False
+        self.thread = None
+
+        self.current_angle = 0.0
+        self.last_duty = None
+        self.last_write = 0.0
+        self.trajectory = ()
+        self.trajectory_start = 0.0
+        self.after_move = None
+        self.sweep_variables = None
+
+        self.commands = 0
+        self.coalesced = 0
+        self.rejected = 0
+        self.writes = 0
+        self.command_latencies = []
+
+    def start(self):
+        with self.condition:
+            if self.running:
+                return
+            self.running = True
+        self.thread = threading.Thread(target=self.run, name='servo', daemon=True)
+        self.thread.start()
+        return self.thread
+
+    def interrupt(self):
+        # Ask the owner thread to exit; it releases the servo on the way out
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+
+    def stop(self, timeout=None):
+        self.interrupt()
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+    def status(self):
+        with self.condition:
+            latencies = sorted(self.command_latencies)
+            return {
+                "mode": self.mode,
+                "owner": self.owner,
+                "angle": self.current_angle,
+                "commands": self.commands,
+                "coalesced": self.coalesced,
+                "rejected": self.rejected,
+                "writes": self.writes,
+                "command_latency_ms_median": latencies[len(latencies) // 2] * 1000 if latencies else None,
+                "command_latency_ms_max": latencies[-1] * 1000 if latencies else None,
+            }
+
+    def submit(self, kind, source, payload=None):
+        # Only the latest command survives until the owner thread picks it up
+        with self.condition:
+            holders = [owner for owner in (self.owner, self.pending and self.pending[1]) if owner]
+            if any(self.PRIORITY[source] < self.PRIORITY[holder] for holder in holders):
+                self.rejected += 1
+                return False
+            if self.pending is not None:
+                self.coalesced += 1
+            self.pending = (kind, source, payload, time.monotonic())
+            self.commands += 1
+            self.condition.notify()
+        return True
+
+    def move_to(self, angle, source='manual'):
+        return self.submit('move', source, float(angle))
+
+    def start_sweep(self, variables, source='opcua'):
+        return self.submit('sweep', source, variables)
+
+    def stop_sweep(self, source='opcua'):
+        return self.submit('release', source)
+
+    def write(self, angle):
+        duty = round(angle_to_duty_cycle(angle), 2)
+        if duty != self.last_duty:
+            self.set_duty(duty)
+            self.last_duty = duty
+            self.writes += 1
+            self.last_write = time.monotonic()
+        self.current_angle = angle
+
+    def release(self):
+        self.set_duty(0)
+        self.last_duty = 0
+        with self.condition:
+            self.mode = 'idle'
+            self.owner = None
+
+    def begin_move(self, target, now):
+        self.trajectory = move_trajectory(
+            round(self.current_angle, 1), target,
+            self.max_velocity, self.max_acceleration, self.profile, self.update_interval
+        )
+        self.trajectory_start = now
+        self.mode = 'move'
+
+    def apply(self, command, now):
+        kind, source, payload, submitted = command
+        with self.condition:
+            self.command_latencies.append(now - submitted)
+            del self.command_latencies[:-1000]
+        if kind == 'release':
+            self.release()
+            return
+
+        with self.condition:
+            self.owner = source
+            self.after_move = None
+            if kind == 'move':
+                self.begin_move(payload, now)
+            elif kind == 'sweep':
+                # Ease into the sweep start instead of jumping to it
+                self.sweep_variables = payload
+                self.after_move = 'sweep'
+                self.begin_move(float(payload['min_angle']), now)
+
+    def next_angle(self, now):
+        if self.mode == 'move':
+            index = int((now - self.trajectory_start) / self.update_interval)
+            if index < len(self.trajectory) - 1:
+                return self.trajectory[index]
+            with self.condition:
+                if self.after_move == 'sweep':
+                    self.mode = 'sweep'
+                    self.sweep_engine.reset(now)
+                else:
+                    self.mode = 'idle'
+                    self.owner = None
+            return self.trajectory[-1]
+
+        if self.mode == 'sweep':
+            if self.sweep_variables.get('stop'):
+                self.release()
+                return None
+            return self.sweep_engine.step(self.sweep_variables, now)
+        return None
+
+    def run(self):
+        try:
+            self.run_loop()
+        finally:
+            self.release()
+
+    def run_loop(self):
+        next_tick = time.monotonic()
+        while True:
+            with self.condition:
+                woke = False
+                while self.running and self.mode == 'idle' and self.pending is None:
+                    self.condition.wait()
+                    woke = True
+                if not self.running:
+                    return
+                command, self.pending = self.pending, None
+
+            if woke:
+                # Respect the rate limit relative to the last hardware write
+                next_tick = max(time.monotonic(), self.last_write + self.update_interval)
+                time.sleep(max(next_tick - time.monotonic(), 0))
+
+            now = time.monotonic()
+            try:
+                if command is not None:
+                    self.apply(command, now)
+                angle = self.next_angle(now)
+                if angle is not None:
+                    self.write(angle)
+            except Exception as e:
+                print(f"Error in servo controller: {e}")
+                self.release()
+
+            next_tick += self.update_interval
+            lateness = time.monotonic() - next_tick
+            if lateness > 0:
+                # Skip the ticks we already missed rather than trying to catch up
+                if self.mode == 'sweep':
+                    self.sweep_engine.record_overrun(lateness)
+                next_tick += math.ceil(lateness / self.update_interval) * self.update_interval
+            time.sleep(max(next_tick - time.monotonic(), 0))
@@ -0,0 +1,120 @@
+import threading
+from collections import deque
+
+
+class Track:
+    def __init__(self, x, y, r, color, confidence, score, vote_window):
+        self.x = float(x)
+        self.y = float(y)
+        self.r = float(r)
+        self.score = float(score)
+        self.votes = deque([(color, confidence)], maxlen=vote_window)
+        self.hits = 1
+        self.misses = 0
+        self.confirmed = False
+
+    def update(self, x, y, r, color, confidence, score, alpha):
+        self.x += alpha * (x - self.x)
+        self.y += alpha * (y - self.y)
+        self.r += alpha * (r - self.r)
+        self.score += alpha * (score - self.score)
+        self.votes.append((color, confidence))
+        self.hits += 1
+        self.misses = 0
+
+    def color(self):
+        # Confidence weighted vote over the last vote_window detections
+        weights = {}
+        for color, confidence in self.votes:
+            weights[color] = weights.get(color, 0.0) + confidence
+        color = max(weights, key=weights.get)
+        return color, weights[color] / len(self.votes)
+
+    def ball(self):
+        color, confidence = self.color()
+        return (int(round(self.x)), int(round(self.y)), int(round(self.r)), color, confidence, self.score)
+
+
+class TemporalFilter:
+    # Smooths the detection stream of one camera. Detections are matched to the nearest
+    # track within match_distance through a grid hash of the tracks, so an update costs
+    # O(balls). Positions, radii and scores are exponentially smoothed, colors are voted
+    # over a sliding window. Count hysteresis: a track is reported once it was seen in
+    # confirm_frames consecutive detections and kept for drop_frames missed ones.
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.enabled = False
+        self.alpha = 0.4
+        self.vote_window = 7
+        self.confirm_frames = 2
+        self.drop_frames = 3
+        self.match_distance = 25
+        self.tracks = []
+
+    def configure(self, enabled, alpha, vote_window, confirm_frames, drop_frames, match_distance):
+        with self.lock:
+            self.enabled = enabled
+            self.alpha = alpha
+            self.vote_window = vote_window
+            self.confirm_frames = confirm_frames
+            self.drop_frames = drop_frames
+            self.match_distance = match_distance
+            self.tracks = []
+
+    def status(self):
+        with self.lock:
+            return {
+                "enabled": self.enabled,
+                "alpha": self.alpha,
+                "vote_window": self.vote_window,
+                "confirm_frames": self.confirm_frames,
+                "drop_frames": self.drop_frames,
+                "match_distance": self.match_distance,
+                "tracks": len(self.tracks),
+                "confirmed_tracks": sum(track.confirmed for track in self.tracks),
+            }
+
+    def update(self, balls):
+        with self.lock:
+            if not self.enabled:
+                return balls
+
+            cell = self.match_distance
+            grid = {}
+            for track in self.tracks:
+                grid.setdefault((int(track.x // cell), int(track.y // cell)), []).append(track)
+
+            matched = set()
+            new_tracks = []
+            for (x, y, r, color, confidence, score) in balls:
+                cell_x, cell_y = int(x // cell), int(y // cell)
+                best, best_distance = None, cell * cell
+                for dx in (-1, 0, 1):
+                    for dy in (-1, 0, 1):
+                        for track in grid.get((cell_x + dx, cell_y + dy), ()):
+                            distance = (track.x - x) ** 2 + (track.y - y) ** 2
+                            if distance < best_distance and id(track) not in matched:
+                                best, best_distance = track, distance
+                if best is None:
+                    new_tracks.append(Track(x, y, r, color, confidence, score, self.vote_window))
+                else:
+                    matched.add(id(best))
+                    best.update(x, y, r, color, confidence, score, self.alpha)
+
+            tracks = []
+            for track in self.tracks:
+                if id(track) not in matched:
+                    track.misses += 1
+                    track.hits = 0
+                    # Unconfirmed tracks were most likely noise, drop them right away
+                    if not track.confirmed or track.misses > self.drop_frames:
+                        continue
+                track.confirmed = track.confirmed or track.hits >= self.confirm_frames
+                tracks.append(track)
+            for track in new_tracks:
+                track.confirmed = self.confirm_frames <= 1
+                tracks.append(track)
+            self.tracks = tracks
+
+            return [track.ball() for track in tracks if track.confirmed]
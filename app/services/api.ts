@@ -8,6 +8,72 @@ export async function trackBalls() {
   return response.json();
 }
 
+// Compact binary ball results, see app/backend/ball_codec.py for the layout
+export const BALLS_MEDIA_TYPE = 'application/vnd.pingpong.balls';
+
+const COLOR_CODES = ['unknown', 'red', 'orange', 'yellow', 'green', 'blue', 'purple', 'white'];
+const HEADER_SIZE = 18;
+
+export interface CompactBallResult {
+  frameId: number;
+  timestamp: number;
+  x: Int16Array;
+  y: Int16Array;
+  radius: Int16Array;
+  colorCodes: Uint8Array;
+  // 0-255 for a color confidence of 0.0-1.0
+  colorConfidence: Uint8Array;
+  // 0-255 for a detection score of 0.0-1.0
+  score: Uint8Array;
+}
+
+export function decodeBalls(buffer: ArrayBuffer): CompactBallResult {
+  const view = new DataView(buffer);
+  if (view.getUint8(0) !== 0x50 || view.getUint8(1) !== 0x42 || view.getUint8(2) !== 3) {
+    throw new Error('Not a pingpong ball payload');
+  }
+  const frameId = view.getUint32(4, true);
+  const timestamp = view.getFloat64(8, true);
+  const count = view.getUint16(16, true);
+
+  // Copy the int16 columns so decoding works regardless of host byte order
+  const readColumn = (index: number) => {
+    const column = new Int16Array(count);
+    const offset = HEADER_SIZE + index * 2 * count;
+    for (let i = 0; i < count; i++) {
+      column[i] = view.getInt16(offset + i * 2, true);
+    }
+    return column;
+  };
+
+  return {
+    frameId,
+    timestamp,
+    x: readColumn(0),
+    y: readColumn(1),
+    radius: readColumn(2),
+    colorCodes: new Uint8Array(buffer, HEADER_SIZE + 6 * count, count),
+    colorConfidence: new Uint8Array(buffer, HEADER_SIZE + 7 * count, count),
+    score: new Uint8Array(buffer, HEADER_SIZE + 8 * count, count),
+  };
+}
+
+export function colorName(code: number) {
+  return COLOR_CODES[code] ?? 'unknown';
+}
+
+export async function trackBallsCompact() {
+  const response = await fetch(`${API_URL}/track-balls`, {
+    headers: {
+      Accept: BALLS_MEDIA_TYPE,
+    },
+  });
+  if (!response.ok) {
+    throw new Error('Failed to track balls');
+  }
+  return decodeBalls(await response.arrayBuffer());
+}
+
 export async function controlServo(angle: number) {
   const response = await fetch(`${API_URL}/control-servo`, {
     method: 'POST',
@@ -23,16 +89,27 @@ export async function controlServo(angle: number) {
 }
 
 interface BallDetectionParams {
+  detector?: 'hough' | 'contour' | 'onnx';
   min_radius: number;
   max_radius: number;
   dp: number;
   minDist: number;
   param1: number;
   param2: number;
+  min_color_confidence?: number;
+  gray_first?: boolean;
+  blur?: 'gaussian' | 'box' | 'median' | 'bilateral' | 'none';
+  blur_kernel?: number;
+  downscale?: number;
+  onnx_input_size?: number;
+  onnx_score_threshold?: number;
+  onnx_nms_threshold?: number;
+  tiles?: number;
 }
 
-export const updateBallParams = async (params: BallDetectionParams) => {
-  const response = await fetch(`${API_URL}/update-ball-params`, {
+// Params whose trial detection exceeds the backend's latency budget are rejected unless forced
+export const updateBallParams = async (params: BallDetectionParams, force = false) => {
+  const response = await fetch(`${API_URL}/update-ball-params${force ? '?force=true' : ''}`, {
     method: 'POST',
     headers: {
       'Content-Type': 'application/json',
@@ -40,7 +117,8 @@ export const updateBallParams = async (params: BallDetectionParams) => {
     body: JSON.stringify(params),
   });
   if (!response.ok) {
-    throw new Error('Failed to update ball parameters');
+    const error = await response.json().catch(() => null);
+    throw new Error(typeof error?.detail === 'string' ? error.detail : 'Failed to update ball parameters');
   }
   return await response.json();
 };
\ No newline at end of file